@@ -25,31 +25,21 @@ import collections
 import matplotlib.pyplot as plt
 import numpy
 import scipy.stats
+import scipy.ndimage
 
 import globals as g
-import ascii
+import geometry
 import gogame
 import utils
 
 log = logging.getLogger(__name__)
 
-def board_points(size):
-    points = []
-    limits = (0, size - 1)
-
-    for i in xrange(size):
-        for j in xrange(size):
-            neighs = []
-            for neigh in [(i, j-1),
-                          (i, j+1),
-                          (i-1, j),
-                          (i+1, j)]:
-                if (limits[0] <= neigh[0] <= limits[1] and
-                    limits[0] <= neigh[1] <= limits[1]):
-                    neighs.append(neigh)
-            points.append(((i, j), neighs))
-    return points
-
+# Game data required by hooks, from cheapest to most expensive to load.
+# Each level includes the ones before it
+HEADERS = 0  # Library index entry: header, size, winner and number of moves
+MOVES   = 1  # Moves and initial board, parsed from SGF
+FINAL   = 2  # Final board
+BOARDS  = 3  # Boards after each move
 
 class Chart(object):
     def __init__(self):
@@ -85,21 +75,95 @@ class Chart(object):
 
 
 class Hook(object):
+    '''Base class of analysis hooks. For each game, compute() calls:
+        - gamestart() with the initial board
+        - move() with the board after each move
+        - game() with all boards as a single (moves, size, size) array
+        - gameover() with the final board
+        And batch() with the final boards of many games as a single
+        (games, size, size) array. <chart> of batch() is the index in <games>
+        of the game to chart, if any. game() and batch() also get the shared
+        features.Features of their boards. end() saves data and results
+    '''
+
+    persistent = True  # Load data from previous runs
+    version = None     # Of hook data, for incremental hooks. Bump it to compute all games again
+    requires = ()      # Names of hooks whose data this hook uses
+    level = BOARDS     # Game data used by this hook
+
     def __init__(self, size):
         self.data = self._load_data(self.__class__.__name__)
+        self.inputs = {}
+        self.computed = {}
+        self._unsaved = []     # Game IDs computed since last save
+        self._logged = 0       # Number of records in data log
+        self._snapshot = 0     # Number of games in data snapshot
+        self._compact = True   # Write a new snapshot on next save
+        if self.version is not None:
+            state = self._load_data(self.__class__.__name__, "state")
+            if state.get('version') == self.version:
+                self.computed = state['games']
+                self._snapshot = len(self.computed)
+                records, complete = self._load_log(self.__class__.__name__)
+                for record in records:
+                    self.computed[record[0]] = record[1]
+                    if len(record) > 2:
+                        self.data[record[0]] = record[2]
+                self._logged = len(records)
+                self._compact = not complete
+            elif self.data:
+                log.info("%s: data of version %s, computing all games with version %s",
+                         self.__class__.__name__, state.get('version'), self.version)
+                self.data = {}
 
     def gamestart(self, game, board, chart=False):
         pass
     def move(self, game, board, move):
         pass
+    def game(self, game, boards, features):
+        pass
     def gameover(self, game, board, chart=False):
         pass
+    def batch(self, games, boards, features, chart=None):
+        pass
     def end(self):
         pass
     def display(self):
         pass
 
+    def merge(self, other):
+        '''Merge the state of <other>, a hook of the same class that computed
+            later games, into this one
+        '''
+        self.data.update(other.data)
+        self.computed.update(other.computed)
+        self._unsaved.extend(other._unsaved)
+
+    def needs(self, gameid, fingerprint):
+        '''Return True if game must be computed by this hook'''
+        return self.version is None or self.computed.get(gameid) != fingerprint
+
+    def done(self, gameid, fingerprint):
+        '''Record that game was computed, after its gameover()'''
+        if self.version is not None:
+            self.computed[gameid] = fingerprint
+            self._unsaved.append(gameid)
+
+    def prune(self, gameids):
+        '''Remove from data the games not in <gameids>, the set of Library games'''
+        if self.version is not None:
+            for gameid in set(self.computed) - gameids:
+                del self.computed[gameid]
+                self.data.pop(gameid, None)
+                self._compact = True
+
+    def overrides(self, method):
+        '''Return True if hook class overrides Hook's <method>'''
+        return getattr(type(self), method).im_func is not getattr(Hook, method).im_func
+
     def _load_data(self, hookname, dataname="data"):
+        if not self.persistent:
+            return {}
         try:
             datafile = os.path.join(g.USERDIR, 'hooks', hookname.lower(), '%s.json' % dataname)
             with open(datafile, 'r') as fp:
@@ -107,14 +171,68 @@ class Hook(object):
         except (IOError, ValueError):
             return {}
 
+    def _load_log(self, hookname):
+        '''Return a list of the (gameid, fingerprint[, data]) records in the
+            data log of <hookname>, one JSON record per line, and False if its
+            last record is truncated by an interrupted run
+        '''
+        records = []
+        try:
+            with open(os.path.join(g.USERDIR, 'hooks', hookname.lower(), 'data.log'), 'r') as fp:
+                for line in fp:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        return records, False
+        except IOError:
+            pass
+        return records, True
+
     def _save_data(self, pretty=True, indent=1):
-        datafile = os.path.join(g.USERDIR, 'hooks', self.__class__.__name__.lower(), 'data.json')
-        utils.safemakedirs(os.path.dirname(datafile))
-        with open(datafile, 'w') as fp:
+        '''Save data as a snapshot, data.json and state.json, and a log,
+            data.log, of the games computed after it. Incremental hooks only
+            append the games computed since the previous save, and compact the
+            log into a new snapshot when it grows larger than it
+        '''
+        hookdir = os.path.join(g.USERDIR, 'hooks', self.__class__.__name__.lower())
+        utils.safemakedirs(hookdir)
+        logfile = os.path.join(hookdir, 'data.log')
+
+        if not (self.version is None or self._compact or
+                self._logged + len(self._unsaved) > self._snapshot):
+            with open(logfile, 'a') as fp:
+                for gameid in self._unsaved:
+                    record = [gameid, self.computed[gameid]]
+                    if gameid in self.data:
+                        record.append(self.data[gameid])
+                    fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self._logged += len(self._unsaved)
+            self._unsaved = []
+            return
+
+        # Empty the log first, so an interrupted compaction loses at most the
+        # games computed since the last snapshot, which are computed again
+        if os.path.exists(logfile):
+            os.remove(logfile)
+        self._logged = 0
+        self._snapshot = len(self.computed)
+        self._unsaved = []
+        self._compact = False
+
+        datafile = os.path.join(hookdir, 'data.json')
+        with open(datafile + '.tmp', 'w') as fp:
             if pretty:
                 fp.write(utils.prettyjson(self.data, indent=indent) + '\n')
             else:
                 json.dump(self.data, fp, sort_keys=True, separators=(',', ': '), indent=indent)
+        os.rename(datafile + '.tmp', datafile)
+
+        if self.version is not None:
+            statefile = os.path.join(hookdir, 'state.json')
+            with open(statefile + '.tmp', 'w') as fp:
+                json.dump(dict(version=self.version, games=self.computed), fp,
+                          sort_keys=True, separators=(',', ':'))
+            os.rename(statefile + '.tmp', statefile)
 
     def histstats(self, data, binwidth=1):
         array = numpy.array(data)
@@ -148,14 +266,14 @@ class Hook(object):
 class MoveHistogram(Hook):
     '''Histogram of number of moves moves per game'''
 
+    version = 1
+    level = HEADERS
+
     def __init__(self, size):
         super(MoveHistogram, self).__init__(size)
 
     def gameover(self, game, board, chart=False):
-        if not game.id:
-            game.setup()
-        moves = len(game.moves)
-        self.data[game.id] = moves
+        self.data[game.id] = game.nummoves
 
     def end(self):
         self._save_data(pretty=False, indent=0)
@@ -230,42 +348,26 @@ class MoveHistogram(Hook):
 class TimeLine(Hook):
     '''Game evolution of stones in board and accumulated prisoners per move'''
 
+    version = 3
+
     def __init__(self, size):
         super(TimeLine, self).__init__(size)
         self.gamedata = {}
 
-    def gamestart(self, game, board, chart=False):
-        if not game.boards:
-            game.play()
-
-        # assuming there is no handicap!
-        self.gamedata = dict(stnblack = [0],
-                             stnwhite = [0],
-                             priblack = [0],
-                             priwhite = [0],
-                             captured = [0],
-                             nummoves = len(game.moves))
-
-    def move(self, game, board, move):
-        blacks, whites = board.stonecount()
-
-        color, _ = move
-        if   color == gogame.BLACK:
-            blackscaptured = 0
-            whitescaptured = self.gamedata['stnwhite'][-1] - whites
-        elif color == gogame.WHITE:
-            blackscaptured = self.gamedata['stnblack'][-1] - blacks
-            whitescaptured = 0
-        else:  # pass
-            blackscaptured = whitescaptured = 0
-
-        self.gamedata['captured'].append(blackscaptured + whitescaptured)
+    def game(self, game, boards, features):
+        # Counts start from the initial board, with any handicap stones
+        blacks = numpy.concatenate(([(features.initialboard == 1).sum()], features.stones(1)))
+        whites = numpy.concatenate(([(features.initialboard == 2).sum()], features.stones(2)))
 
-        self.gamedata['priblack'].append(self.gamedata['priblack'][-1] + blackscaptured)
-        self.gamedata['priwhite'].append(self.gamedata['priwhite'][-1] + whitescaptured)
+        blackscaptured = features.captures(1)
+        whitescaptured = features.captures(2)
 
-        self.gamedata['stnblack'].append(blacks)
-        self.gamedata['stnwhite'].append(whites)
+        self.gamedata = dict(stnblack = blacks.tolist(),
+                             stnwhite = whites.tolist(),
+                             priblack = numpy.concatenate(([0], blackscaptured.cumsum())).tolist(),
+                             priwhite = numpy.concatenate(([0], whitescaptured.cumsum())).tolist(),
+                             captured = numpy.concatenate(([0], blackscaptured + whitescaptured)).tolist(),
+                             nummoves = len(game.moves))
 
     def gameover(self, game, board, chart=False):
         self.data[game.id] = self.gamedata
@@ -281,13 +383,16 @@ class TimeLine(Hook):
                       xlabel="Moves", ylabel="Stones", loc=2)
             chart.save("timeline_%s" % game.id)
             chart.close()
-            self.end()
 
     def end(self):
         self._save_data()
+        if not self.data:
+            return
 
+        # In Game ID order, so results do not depend on how data was merged
         games = len(self.data)
-        result = {key: tuple(gamedata[key] for gamedata in self.data.itervalues()) for key in self.gamedata}
+        gamesdata = [self.data[_] for _ in sorted(self.data)]
+        result = {key: tuple(gamedata[key] for gamedata in gamesdata) for key in gamesdata[0]}
         result['nummoves'] = tuple(sorted(result['nummoves']))
 
         self._save_result(games, result)
@@ -347,23 +452,25 @@ class Severity(Hook):
         Uses data from TimeLine
     '''
 
+    version = 1
+    requires = ('TimeLine',)
+    level = HEADERS
+
     def __init__(self, size):
         super(Severity, self).__init__(size)
-        if g.options.command == "calculate":
-            self.timeline = self._load_data("TimeLine")
-            self.gamedata = []
+        self.gamedata = []
 
     def gameover(self, game, board, chart=False):
         self.gamedata = []
         deltamoves = 0
-        for prisoners in self.timeline[game.id]["captured"][1:]:
+        for prisoners in self.inputs['TimeLine'][game.id]["captured"][1:]:
             deltamoves += 1
             if prisoners > 0:
                 self.gamedata.append((deltamoves, prisoners))
                 deltamoves = 0
 
         self.data[game.id] = self.gamedata
-        if chart:
+        if chart and self.gamedata:
             deltalist, severitylist = zip(*self.gamedata)
             chart = Chart()
             chart.plot(deltalist, severitylist, 'bo:')
@@ -373,13 +480,12 @@ class Severity(Hook):
             chart.set(title="Severity Scatter - Game %s\n%s\n%d moves, %d captures, 1st capture at %s" % (
                                 game.id.upper(),
                                 game.description,
-                                len(game.moves),
+                                game.nummoves,
                                 len(self.gamedata),
                                 self.gamedata[0]),
                       xlabel="Moves since last capture", ylabel="Stones captured", legend=False)
             chart.save("severity_%s" % game.id)
             chart.close()
-            self.end()
 
     def end(self):
         self._save_data()
@@ -485,59 +591,53 @@ class Severity(Hook):
 class DensityGradient(Hook):
     '''Density of end game stones in concentric board perimeters'''
 
+    version = 1
+    level = FINAL
+
     def __init__(self, size, width=2):
         super(DensityGradient, self).__init__(size)
         self.width = width
 
-        perimeters = gogame.Board.perimeters(size, width=self.width)
-        areas = [float(len(_)) for _ in perimeters]
-        self.perimeterareas = zip(perimeters, areas)
-        self.xaxis = range(0, len(perimeters) * self.width, width)
+        self.perimeters = geometry.perimeters(size, self.width)
+        self.areas = self.perimeters.sum(axis=0)
+        self.xaxis = range(0, self.perimeters.shape[1] * self.width, width)
 
         self.totalarea = float(size**2)
 
-    def gamestart(self, game, board, chart=False):
-        if not game.boards:
-            game.play()
-
-    def gameover(self, game, board, chart=False):
-        totalstones = sum(board.stonecount())
-        totaldensity = totalstones / self.totalarea
-        normdensities = []
-        absdensities = []
-
-        for perimeter, area in self.perimeterareas:
-            stones = 0
-            for point in perimeter:
-                if not board.get(*point) == gogame.EMPTY:
-                    stones += 1
-            density = stones / area
-            absdensities.append(density)
-            normdensities.append(density/totaldensity)
+    def batch(self, games, boards, features, chart=None):
+        totalstones = features.stones()
+        totaldensities = totalstones / self.totalarea
+        absdensities = features.sums(self.perimeters) / self.areas
+        normdensities = absdensities / totaldensities[:, numpy.newaxis]
 
-        coeffs = tuple(numpy.polyfit(self.xaxis, normdensities, deg=1))
+        # One regression per game, all at once
         # As a reference, 'm' over normalized densities == 'm' over absolute densities * totaldensity
+        allcoeffs = numpy.polyfit(self.xaxis, normdensities.T, deg=1).T
 
-        self.data[game.id] = dict(absdensities=absdensities,
-                                  normdensities=normdensities,
-                                  coeffs=coeffs,
-                                  stones=totalstones,
-                                  density=totaldensity)
+        for n, game in enumerate(games):
+            self.data[game.id] = dict(absdensities=absdensities[n].tolist(),
+                                      normdensities=normdensities[n].tolist(),
+                                      coeffs=tuple(allcoeffs[n].tolist()),
+                                      stones=int(totalstones[n]),
+                                      density=float(totaldensities[n]))
 
-        if chart:
-            chart = Chart()
-            chart.plot(self.xaxis, normdensities, 'bo-', label="Data")
-            chart.plot(self.xaxis, numpy.poly1d(coeffs)(self.xaxis), 'r-', label="LinReg, m=%.03f" % coeffs[0])
-            chart.set(title="Density Gradient - Game %s\n%s\n%d stones, board density %.03f" % (
-                                game.id.upper(),
-                                game.description,
-                                totalstones,
-                                totaldensity),
-                      xlabel="Distance from board edge\nPerimeters of width %d" % self.width,
-                      ylabel="Normalized stone density")
-            chart.save("densitygradient_%s" % game.id)
-            chart.close()
-            self.end()
+        if chart is not None:
+            self._chart(games[chart])
+
+    def _chart(self, game):
+        data = self.data[game.id]
+        chart = Chart()
+        chart.plot(self.xaxis, data['normdensities'], 'bo-', label="Data")
+        chart.plot(self.xaxis, numpy.poly1d(data['coeffs'])(self.xaxis), 'r-', label="LinReg, m=%.03f" % data['coeffs'][0])
+        chart.set(title="Density Gradient - Game %s\n%s\n%d stones, board density %.03f" % (
+                            game.id.upper(),
+                            game.description,
+                            data['stones'],
+                            data['density']),
+                  xlabel="Distance from board edge\nPerimeters of width %d" % self.width,
+                  ylabel="Normalized stone density")
+        chart.save("densitygradient_%s" % game.id)
+        chart.close()
 
     def end(self):
         self._save_data()
@@ -617,6 +717,8 @@ class DensityGradient(Hook):
 
 
 class StonesPerSquare(Hook):
+    level = FINAL
+
     def __init__(self, size):
         self.size = size
         self.games = 0
@@ -635,90 +737,73 @@ class StonesPerSquare(Hook):
             center.gamewiners = []
             center.gamelosers = []
 
-    def gameover(self, game, board, chart=False, discard=False):
-        if discard:
-            return
+        # Areas of all centers, as a (points, centers * areas) matrix
+        self.areas = numpy.hstack([center.areas for center in self.points])
+
+    def batch(self, games, boards, features, chart=None):
+        shape = (len(boards), len(self.points), -1)
+        allblacks = features.sums(self.areas, 1).astype(int).reshape(shape)
+        allwhites = features.sums(self.areas, 2).astype(int).reshape(shape)
+
+        for n, game in enumerate(games):
+            self.games += 1
+            blackwinner = game.winner == gogame.BLACK
+
+            for c, center in enumerate(self.points):
+                center.blacks = allblacks[n, c].tolist()
+                center.whites = allwhites[n, c].tolist()
+                center.stones = (allblacks[n, c] + allwhites[n, c]).tolist()
+
+                center.gamestones.append(center.stones)
+                center.gameblacks.append(center.blacks)
+                center.gamewhites.append(center.whites)
+                if blackwinner:
+                    center.gamewiners.append(center.blacks)
+                    center.gamelosers.append(center.whites)
+                else:
+                    center.gamewiners.append(center.whites)
+                    center.gamelosers.append(center.blacks)
 
-        self.games += 1
-        if self.games % 101 == 0:
-            chart = True
+            if n == chart:
+                self._chart(game, blackwinner)
+
+            for center in self.points:
+                del center.stones
+                del center.blacks
+                del center.whites
 
-        if game.winner == gogame.BLACK:
-            blackwinner = True
+    def _chart(self, game, blackwinner):
+        if blackwinner:
             bw = 1; ww = 1
             bs = '-'; ws = '--'
         else:
-            blackwinner = False
             bw = 1; ww = 1
             bs = '--'; ws = '-'
 
-        if chart:
-            figtotal = Chart()
-            figcolor = Chart()
+        figtotal = Chart()
+        figcolor = Chart()
 
         for center in self.points:
-            blacks = 0
-            whites = 0
-            center.stones = []
-            center.blacks = []
-            center.whites = []
-
-            for i, perimeter in enumerate(center.perimeters):
-                if center.corner:
-                    for point in perimeter:
-                        color = board.get(*point)
-                        if   color == gogame.BLACK: blacks += 1
-                        elif color == gogame.WHITE: whites += 1
-                    center.stones.append(blacks + whites)
-                    center.blacks.append(blacks)
-                    center.whites.append(whites)
-                else:
-                    if i % 2 == 0:
-                        for point in center.perimeters[i/2]:
-                            color = board.get(*point)
-                            if   color == gogame.BLACK: blacks += 1
-                            elif color == gogame.WHITE: whites += 1
-                        center.stones.append(blacks + whites)
-                        center.blacks.append(blacks)
-                        center.whites.append(whites)
-                    else:
-                        center.stones.append(center.stones[-1])
-                        center.blacks.append(center.blacks[-1])
-                        center.whites.append(center.whites[-1])
-
-            center.gamestones.append(center.stones)
-            center.gameblacks.append(center.blacks)
-            center.gamewhites.append(center.whites)
-            if blackwinner:
-                center.gamewiners.append(center.blacks)
-                center.gamelosers.append(center.whites)
-            else:
-                center.gamewiners.append(center.whites)
-                center.gamelosers.append(center.blacks)
-
-            if chart:
-                figcolor.plot(center.blacks, label=center.label + " - Black", color=center.color, lw=bw, ls=bs)
-                figcolor.plot(center.whites, label=center.label + " - White", color=center.color, lw=ww, ls=ws)
-                figtotal.plot(center.stones, label=center.label,  color=center.color)
-
-            del center.stones
-            del center.blacks
-            del center.whites
-
-        if chart:
-            figcolor.set(loc=2, xlabel="Area (distance from point to edge)", ylabel="Stones",
-                         title="Stones per increasing areas - Colors - Game %s" % game.name)  # loc=2: legend on upper left
-            figtotal.set(loc=2, xlabel="Area (distance from point to edge)", ylabel="Stones",
-                         title="Stones per increasing areas - Total - Game %s" % game.name)
-
-            #plt.show()
-            figcolor.save("stones_color_%s" % game.name)
-            figtotal.save("stones_total_%s" % game.name)
-            figcolor.close()
-            figtotal.close()
-
-            log.info("Games processed: %d", self.games)
-            self.end()
+            figcolor.plot(center.blacks, label=center.label + " - Black", color=center.color, lw=bw, ls=bs)
+            figcolor.plot(center.whites, label=center.label + " - White", color=center.color, lw=ww, ls=ws)
+            figtotal.plot(center.stones, label=center.label,  color=center.color)
+
+        figcolor.set(loc=2, xlabel="Area (distance from point to edge)", ylabel="Stones",
+                     title="Stones per increasing areas - Colors - Game %s" % game.id)  # loc=2: legend on upper left
+        figtotal.set(loc=2, xlabel="Area (distance from point to edge)", ylabel="Stones",
+                     title="Stones per increasing areas - Total - Game %s" % game.id)
+
+        #plt.show()
+        figcolor.save("stones_color_%s" % game.id)
+        figtotal.save("stones_total_%s" % game.id)
+        figcolor.close()
+        figtotal.close()
+
+    def merge(self, other):
+        self.games += other.games
+        for center, othercenter in zip(self.points, other.points):
+            for name in ('gamestones', 'gameblacks', 'gamewhites', 'gamewiners', 'gamelosers'):
+                getattr(center, name).extend(getattr(othercenter, name))
 
     def end(self):
         chartlin = Chart()
@@ -760,6 +845,8 @@ class StonesPerSquare(Hook):
 
 
 class FractalDimension(Hook):
+    level = FINAL
+
     def __init__(self, size):
         self.size = size
         self.games = 0
@@ -772,61 +859,55 @@ class FractalDimension(Hook):
                        )
         self.totalstones = []
 
+        # Squares of all corners, as a (points, corners * squares) matrix
+        self.areas = numpy.hstack([corner.areas for corner in self.corners])
 
-    def gameover(self, game, board, chart=False, discard=False):
-        if discard:
-            return
 
-        self.games += 1
-        if self.games % 10000 == 0:
-            chart = True
-
-        for corner in self.corners:
-            stones = 0
-            corner.stones = []
-            for perimeter in corner.perimeters:
-                for point in perimeter:
-                    if board.get(*point) is not None:
-                        stones += 1
-                corner.stones.append(stones)
-
-        gamestones = []
-        corners = float(len(self.corners))
-        for perimeter in xrange(self.size):
-            stones = 0
-            for corner in self.corners:
-                stones += corner.stones[perimeter]
-            if stones > 0:
-                gamestones.append(stones / corners)
+    def batch(self, games, boards, features, chart=None):
+        # Stones in squares of increasing side, averaged over all corners
+        allstones = features.sums(self.areas).reshape(len(boards), len(self.corners), -1).mean(axis=1)
+
+        # Linear regression of log(stones) over log(side), for each game only
+        # on sides with stones, all at once using the closed form
+        valid = allstones > 0
+        logx = numpy.log(numpy.arange(1, self.size + 1)) * valid
+        logy = numpy.log(numpy.where(valid, allstones, 1))
+        n = valid.sum(axis=1)
+        sx, sy = logx.sum(axis=1), logy.sum(axis=1)
+        slopes = (n * (logx * logy).sum(axis=1) - sx * sy) / (n * (logx * logx).sum(axis=1) - sx * sx)
+        intercepts = (sy - slopes * sx) / n
+
+        self.totalstones.extend(slopes.tolist())
 
+        for i, game in enumerate(games):
+            self.games += 1
+            if i == chart:
+                self._chart(game, allstones[i][valid[i]].tolist(), (slopes[i], intercepts[i]))
+
+    def _chart(self, game, gamestones, coeffs):
         samples = len(gamestones)
         squaresides = list(xrange(1 + self.size - samples, self.size + 1))
-        logx = numpy.log(squaresides)
-        logy = numpy.log(gamestones)
-        coeffs = numpy.polyfit(logx, logy, deg=1)
         poly = numpy.poly1d(coeffs)
         yfit = lambda x: numpy.exp(poly(numpy.log(x)))
 
-        self.totalstones.append(coeffs[0])
-
-        if chart:
-            figavg = Chart()
-            figavg.plot(squaresides, gamestones, 'bo', label="Game Data")
-            figavg.plot(squaresides, yfit(squaresides), 'r-', label="Linear Regression")
-            figavg.set(loc=2, xlabel="Square Side", ylabel="Stones", loglog=True,
-                       title="Stones per increasing squares - Game %s, m = %.2f" % (game.name, coeffs[0]))
-            figavg.save("fractal_%s_log" % game.name)
-            figavg.close()
-
-            figlin = Chart()
-            figlin.plot(squaresides, gamestones, label="Stones", color="red")
-            figlin.set(loc=2, xlabel="Square Side", ylabel="Stones",
-                       title="Stones per increasing squares - Game %s" % game.name)
-            figlin.save("fractal_%s" % game.name)
-            figlin.close()
-
-            log.info("Games processed: %d", self.games)
-            self.end()
+        figavg = Chart()
+        figavg.plot(squaresides, gamestones, 'bo', label="Game Data")
+        figavg.plot(squaresides, yfit(squaresides), 'r-', label="Linear Regression")
+        figavg.set(loc=2, xlabel="Square Side", ylabel="Stones", loglog=True,
+                   title="Stones per increasing squares - Game %s, m = %.2f" % (game.id, coeffs[0]))
+        figavg.save("fractal_%s_log" % game.id)
+        figavg.close()
+
+        figlin = Chart()
+        figlin.plot(squaresides, gamestones, label="Stones", color="red")
+        figlin.set(loc=2, xlabel="Square Side", ylabel="Stones",
+                   title="Stones per increasing squares - Game %s" % game.id)
+        figlin.save("fractal_%s" % game.id)
+        figlin.close()
+
+    def merge(self, other):
+        self.games += other.games
+        self.totalstones.extend(other.totalstones)
 
     def end(self):
         games = len(self.totalstones)
@@ -846,55 +927,25 @@ class StoneCountCenterPoint(object):
 
         self.corner = self.point[0] in limits and self.point[1] in limits
 
-        self.perimeters = []
-        for i in xrange(limits[1] - limits[0] + 1):
-            self.perimeters.append(self.square_perimeter_points(i, limits))
-
-    def square_perimeter_points(self, distance, limits):
-        points = []
-
-        def append(point):
-            if (limits[0] <= point[0] <= limits[1] and
-                limits[0] <= point[1] <= limits[1]):
-                points.append(point)
-
-        if distance == 0:
-            append(self.point)
-            return points
-
-        # Bottom and Top rows
-        for x in xrange(self.point[0] - distance,
-                        self.point[0] + distance + 1):
-            append((x, self.point[1] - distance))
-            append((x, self.point[1] + distance))
-
-        # Left and Right columns (excluding corners)
-        for y in xrange(self.point[1] - distance + 1,
-                        self.point[1] + distance - 1 + 1):
-            append((self.point[0] - distance, y))
-            append((self.point[0] + distance, y))
-
-        return points
+        # Squares of increasing distance from point, clipped to the board.
+        # For points other than corners each square is counted twice
+        size = limits[1] - limits[0] + 1
+        self.perimeters = geometry.rings(size, self.point)
+        self.areas = geometry.squares(size, self.point, not self.corner)
 
 
 class LibertiesPerMove(Hook):
     def __init__(self, size):
+        self.size = size
         self.totalliberties = []
         self.gameliberties = []
         self.maxmoves = 0
-        self.points = board_points(size)
 
     def gamestart(self, game, board, chart):
         self.gameliberties = []
 
-    def move(self, game, board, move):
-        liberties = 0
-        for point, neighs in self.points:
-            if board.get(*point) is not None:
-                for neigh in neighs:
-                    if board.get(*neigh) is None:
-                        liberties += 1
-        self.gameliberties.append(liberties)
+    def game(self, game, boards, features):
+        self.gameliberties = features.liberties().tolist()
 
     def gameover(self, game, board, chart=False, discard=False):
         if discard:
@@ -908,10 +959,14 @@ class LibertiesPerMove(Hook):
         if chart:
             chart = Chart()
             chart.plot(self.gameliberties, label="Liberties", color="red")
-            chart.set(loc=2, xlabel="Moves", ylabel="Liberties", title="Liberties per move - Game %s" % game.name)  # loc=2: legend on upper left
-            chart.save("liberties_%s" % game.name)
+            chart.set(loc=2, xlabel="Moves", ylabel="Liberties", title="Liberties per move - Game %s" % game.id)  # loc=2: legend on upper left
+            chart.save("liberties_%s" % game.id)
             chart.close()
 
+    def merge(self, other):
+        self.totalliberties.extend(other.totalliberties)
+        self.maxmoves = max(self.maxmoves, other.maxmoves)
+
     def end(self):
         libavg = []
         libmin = []
@@ -965,15 +1020,17 @@ class Territory(object):
 
 
 class Territories(Hook):
+    level = FINAL
+
     def __init__(self, size):
-        self.points = board_points(size)
+        self.size = size
         self.totalterritories = []
         self.gameterritories = []
         self.gameskip = False
         self.games = 0
 
     def gamestart(self, game, board, chart=False):
-        self.gameskip = not game.get_root().get("RU") == "AGA"
+        self.gameskip = not game.header.get("RU") == "AGA"
         self.gameterritories = []
 
     def gameover(self, game, board, chart=False, discard=False):
@@ -982,32 +1039,70 @@ class Territories(Hook):
 
         self.games += 1
 
-        for point, neighs in self.points:
-            color = board.get(*point)
-            if color is None:
-                for neigh in neighs:
-                    for t in self.gameterritories:
-                        if neigh in t.points:
-                            t.points.append(point)
-                            break
-                    else:
-                        continue
-                    break
-                else:
-                    t = Territory()
-                    t.points.append(point)
-                    for neigh in neighs:
-                        if board.get(*neigh) is None:
-                            t.points.append(neigh)
-                    self.gameterritories.append(t)
-
-        print ascii.render_board(board)
+        # Connected empty regions, and the colors of stones bordering each,
+        # as a bitwise OR of color codes: 1 black, 2 white, 3 both
+        labels, regions = scipy.ndimage.label(board.board == 0)
+        labels = labels.ravel()
+        colors = board.board.ravel()
+        points, neighbours = geometry.pairs(self.size)
+        border = (labels[points] > 0) & (colors[neighbours] > 0)
+        owners = numpy.zeros(regions + 1, dtype=numpy.uint8)
+        numpy.bitwise_or.at(owners, labels[points][border], colors[neighbours][border])
+
+        for region in xrange(1, regions + 1):
+            t = Territory()
+            t.points = [divmod(_, self.size) for _ in numpy.flatnonzero(labels == region).tolist()]
+            if owners[region] in (1, 2):
+                t.color = gogame.COLORS[owners[region]]
+            self.gameterritories.append(t)
+
+        log.debug("Game %s territories:\n%s", game.id, board.ascii())
         for territory in sorted(self.gameterritories, key=lambda x: len(x.points)):
-            continue
-            log.info("%d: %r",  len(territory.points), territory.points)
-        print
+            log.debug("%d %r: %r", len(territory.points), territory.color, territory.points)
 
+    def merge(self, other):
+        self.games += other.games
+        self.totalterritories.extend(other.totalterritories)
 
     def end(self):
         log.info("Territories: %d", self.games)
         pass
+
+
+def hookclasses():
+    '''Return a dict of all hook classes, by lowercase class name'''
+    return dict((cls.__name__.lower(), cls) for cls in Hook.__subclasses__())
+
+
+def schedule(names, size):
+    '''Return new instances of the hooks of <names>, and of all hooks they
+        require, in dependency order, so each hook runs after the hooks it
+        requires. Each hook gets the data of the hooks it requires in .inputs,
+        by name, with the data of a game available from the gameover() of its
+        hook on
+    '''
+    classes = hookclasses()
+    order = []
+
+    def visit(cls, path):
+        if cls in path:
+            raise ValueError("Hook dependency cycle: %s" %
+                             " -> ".join(_.__name__ for _ in path + (cls,)))
+        if cls in order:
+            return
+        for name in cls.requires:
+            required = classes[name.lower()]
+            if required.version is None:
+                raise ValueError("Hook %s requires %s, which has no per-game data" %
+                                 (cls.__name__, name))
+            visit(required, path + (cls,))
+        order.append(cls)
+
+    for name in names:
+        visit(classes[name.lower()], ())
+
+    hooks = [cls(size) for cls in order]
+    byname = dict((hook.__class__.__name__, hook) for hook in hooks)
+    for hook in hooks:
+        hook.inputs = dict((name, byname[name].data) for name in hook.requires)
+    return hooks
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2014 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+'''Position features: quantities of many boards at once, shared by hooks
+
+    compute creates a Features for the boards of each game, and another for
+    the final boards of each batch of games, and hands it to all hooks. Each
+    feature is computed on first use, for all boards in a single numpy pass,
+    and then kept, so hooks asking for the same feature share its arrays.
+    Arrays are read-only. Colors are the color codes of board arrays, an
+    index of gogame.COLORS
+'''
+
+import functools
+import inspect
+
+import numpy
+import scipy.ndimage
+
+import geometry
+
+
+def _cached(func):
+    # Omitted arguments take their defaults, so they share the same key
+    spec = inspect.getargspec(func)
+    defaults = spec.defaults or ()
+    nargs = len(spec.args) - 1
+
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        args += defaults[len(defaults) - (nargs - len(args)):]
+        key = (func.__name__,) + args
+        if key not in self._cache:
+            result = func(self, *args)
+            if isinstance(result, numpy.ndarray):
+                result.flags.writeable = False
+            self._cache[key] = result
+        return self._cache[key]
+    return wrapper
+
+
+class Features(object):
+    '''Features of <boards>, a (positions, size, size) array of color codes
+        For the boards of a game, <initialboard> is the board before the first
+        one, and <colors> the array of color codes of each move
+    '''
+
+    def __init__(self, boards, initialboard=None, colors=None):
+        self.boards = boards
+        self.size = boards.shape[-1]
+        self.points = boards.reshape(len(boards), -1)
+        self.initialboard = initialboard
+        self.colors = colors
+        self._cache = {}
+        self._sums = {}  # id(mask): (mask, {color: sums})
+
+    def __len__(self):
+        return len(self.boards)
+
+    @_cached
+    def mask(self, color=None):
+        '''Return a (positions, points) bool array of the points of <color>,
+            or of all stones if None
+        '''
+        if color is None:
+            return self.points != 0
+        return self.points == color
+
+    @_cached
+    def stones(self, color=None):
+        '''Return the number of stones of <color>, or of all stones, per board'''
+        return self.mask(color).sum(axis=1)
+
+    @_cached
+    def liberties(self):
+        '''Return the liberties of all stones per board, counting shared
+            liberties once per stone: the number of (stone, empty neighbour)
+            pairs
+        '''
+        points, neighbours = geometry.pairs(self.size)
+        return (self.mask()[:, points] & (self.points[:, neighbours] == 0)).sum(axis=1)
+
+    @_cached
+    def groups(self, color=None):
+        '''Return the number of groups of <color>, or of all stones, per board
+            Groups are orthogonally connected stones of a color
+        '''
+        # Labeled in a single pass, not connecting boards, so the labels of
+        # each board follow the ones of the boards before it
+        structure = numpy.zeros((3, 3, 3), dtype=bool)
+        structure[1] = scipy.ndimage.generate_binary_structure(2, 1)
+        result = numpy.zeros(len(self), dtype=int)
+        for code in ((color,) if color is not None else (1, 2)):
+            labels, _ = scipy.ndimage.label(self.boards == code, structure)
+            last = numpy.maximum.accumulate(labels.reshape(len(self), -1).max(axis=1))
+            result += numpy.diff(numpy.concatenate(([0], last)))
+        return result
+
+    @_cached
+    def captures(self, color):
+        '''Return the number of stones of <color> captured by each move, the
+            drop in its stone count caused by moves of the other color
+            Requires <initialboard> and <colors>
+        '''
+        counts = numpy.concatenate(([(self.initialboard == color).sum()], self.stones(color)))
+        return numpy.where(self.colors != color, counts[:-1] - counts[1:], 0)
+
+    def sums(self, mask, color=None):
+        '''Return a (positions, regions) array of the stones of <color>, or of
+            all stones, in each region of <mask>, a (points, regions) matrix
+            such as the ones of geometry. Kept for as long as <mask> is the
+            same object
+        '''
+        cached = self._sums.get(id(mask))
+        if cached is None or cached[0] is not mask:
+            cached = self._sums[id(mask)] = (mask, {})
+        if color not in cached[1]:
+            result = numpy.dot(self.mask(color), mask)
+            result.flags.writeable = False
+            cached[1][color] = result
+        return cached[1][color]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2014 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+'''Board geometry: point indexes and masks of board regions
+
+    Points are identified by their index in the flattened (size, size) board,
+    row * size + col, so the stones of a region are board.flat[index], and
+    regions of many boards can be counted with a dot product of flattened
+    boards and a (points, regions) mask matrix.
+    Everything is computed once per board size and kept in memory. Arrays are
+    shared by all callers, so they are read-only
+'''
+
+import functools
+
+import numpy
+
+
+_cache = {}
+
+
+def _memoized(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__,) + args + tuple(sorted(kwargs.items()))
+        if key not in _cache:
+            result = func(*args, **kwargs)
+            if isinstance(result, numpy.ndarray):
+                result.flags.writeable = False
+            _cache[key] = result
+        return _cache[key]
+    return wrapper
+
+
+@_memoized
+def neighbours(size):
+    '''Return a list, by point index, of the index lists of the orthogonal
+        neighbours of each point. Plain lists, for fast access from Python
+    '''
+    result = []
+    for row in xrange(size):
+        for col in xrange(size):
+            result.append([r * size + c for r, c in ((row - 1, col), (row + 1, col),
+                                                     (row, col - 1), (row, col + 1))
+                           if 0 <= r < size and 0 <= c < size])
+    return result
+
+
+@_memoized
+def pairs(size):
+    '''Return a (2, pairs) array of the indexes of all ordered pairs of
+        orthogonal neighbours, so <board.flat[pairs[0]]> and
+        <board.flat[pairs[1]]> are the colors of each point and its neighbour
+    '''
+    return numpy.array([(point, neighbour)
+                        for point, neighs in enumerate(neighbours(size))
+                        for neighbour in neighs]).T
+
+
+@_memoized
+def edgedistance(size):
+    '''Return the distance of each point to the nearest board edge'''
+    rows, cols = numpy.indices((size, size))
+    return numpy.minimum(numpy.minimum(rows, cols),
+                         numpy.minimum(size - 1 - rows, size - 1 - cols)).ravel()
+
+
+@_memoized
+def perimeters(size, width=1):
+    '''Return a (points, perimeters) matrix of concentric board perimeters of
+        <width>, from the edge to the center. Same regions as
+        gogame.Board.perimeters()
+    '''
+    perimeter = edgedistance(size) // width
+    return (perimeter[:, numpy.newaxis] == numpy.arange(perimeter.max() + 1)).astype(float)
+
+
+@_memoized
+def distances(size, point):
+    '''Return the distance of each point to <point>, a (row, col) tuple,
+        counting diagonal steps as one, so points at the same distance form
+        squares centered at <point>
+    '''
+    rows, cols = numpy.indices((size, size))
+    return numpy.maximum(abs(rows - point[0]), abs(cols - point[1])).ravel()
+
+
+@_memoized
+def rings(size, point):
+    '''Return a list of index arrays of the points at each distance from
+        <point>, clipped to the board, from 0 to size - 1
+    '''
+    distance = distances(size, point)
+    result = []
+    for d in xrange(size):
+        ring = numpy.flatnonzero(distance == d)
+        ring.flags.writeable = False
+        result.append(ring)
+    return result
+
+
+@_memoized
+def squares(size, point, halfsteps=False):
+    '''Return a (points, size) matrix of squares of increasing distance from
+        <point>, clipped to the board. Square i contains all points up to
+        distance i, or up to i // 2 if <halfsteps>, so each square is repeated
+    '''
+    steps = numpy.arange(size)
+    if halfsteps:
+        steps //= 2
+    return (distances(size, point)[:, numpy.newaxis] <= steps).astype(float)
+
+
+@_memoized
+def symmetries(size):
+    '''Return a (8, points) array of the point indexes of the 8 symmetries of a
+        <size> board, its 4 rotations and their reflections, so that
+        <board.flat[symmetries[s]]> is the board transformed by symmetry s.
+        The first one is the identity
+    '''
+    board = numpy.arange(size * size).reshape(size, size)
+    return numpy.array([numpy.rot90(b, k).ravel() for b in (board, board.T) for k in xrange(4)])
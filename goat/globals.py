@@ -36,6 +36,13 @@ APPDIR     = os.path.abspath(os.path.dirname(__file__) or '.')
 DATADIR    = os.path.join(APPDIR, 'data')
 USERDIR    = xdg.BaseDirectory.save_data_path(APPNAME)
 LIBRARYDIR = os.path.join(USERDIR, 'library')
+INDEXFILE  = os.path.join(USERDIR, 'library.db')
+LIBRARYFILE= os.path.join(USERDIR, 'library.pack')
+BOARDSFILE = os.path.join(USERDIR, 'boards.pack')
+MOVESFILE  = os.path.join(USERDIR, 'moves.pack')
+POSITIONSFILE = os.path.join(USERDIR, 'positions.idx')
+PATTERNSFILE  = os.path.join(USERDIR, 'patterns.idx')
+OPENINGSFILE  = os.path.join(USERDIR, 'openings.npz')
 RESULTSDIR = os.path.join(os.path.expanduser("~"), APPNAME, "results_%s" % time.strftime('%Y-%m-%d_%H.%M.%S'))
 CONFIGDIR  = xdg.BaseDirectory.save_config_path(APPNAME)
 CACHEDIR   = os.path.join(xdg.BaseDirectory.xdg_cache_home, APPNAME)
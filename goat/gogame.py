@@ -17,16 +17,17 @@
 
 '''Go Game, Board, Moves classes wrappers'''
 
-import os
+import re
 import logging
-import json
+import struct
+import collections
+import hashlib
 
-import gomill.sgf
-import gomill.sgf_moves
-import gomill.sgf_properties
+import numpy
 
 import globals as g
-import utils
+import geometry
+import pack
 
 
 log = logging.getLogger(__name__)
@@ -35,181 +36,860 @@ EMPTY = ' '
 BLACK = '#'
 WHITE = 'O'
 
+# Board color codes are the index of each color in COLORS
+COLORS = (EMPTY, BLACK, WHITE)
+
+# Local patterns: square area of PATTERN_SIZE around each move, points
+# outside the board having color code OFFBOARD. See hash_patterns()
+PATTERN_SIZE = 5
+OFFBOARD = 3
+
 
 class GoGameError(Exception):
     pass
 
 
+_sgfstart  = re.compile(r'\(\s*;')
+_sgftoken  = re.compile(r'''\s*(?:
+    ([;()])                                         # delimiter
+    | ([A-Za-z]+) \s*                               # property identifier,
+      \[ ([^\\\]]*(?:\\.[^\\\]]*)*) \]              # first value
+      ((?:\s*\[[^\\\]]*(?:\\.[^\\\]]*)*\])*)        # and all others, unsplit
+    | (\S)                                          # anything else is malformed
+)''', re.DOTALL | re.VERBOSE)
+_sgfvalues = re.compile(r'\[([^\\\]]*(?:\\.[^\\\]]*)*)\]', re.DOTALL)
+_sgfescape = re.compile(r'\\(\r\n?|\n\r?)|\\(.)', re.DOTALL)
+_sgfspaces = re.compile(r'\s')
+_lowercase = ''.join(chr(_) for _ in xrange(ord('a'), ord('z') + 1))
+_sgfcolors = {'B': BLACK, 'W': WHITE}
+
+
+def _sgfnodes(sgfdata, rootonly=False):
+    '''Stream the main line of the first game in raw SGF data, without
+        building a game tree. Yield a (node, identifier, value, others) tuple
+        for each property, <node> being the index of its node in the main line,
+        0 for the root, <value> its first raw value and <others> the remaining
+        raw values, still bracketed. The main line follows the first variation
+        of every node, so reading stops at the first closing parenthesis
+        If <rootonly>, data is tokenized only as it is read, so consumers can
+        stop after the root node cheaply. Otherwise all data is tokenized at
+        once, which is faster for reading whole games
+    '''
+    match = _sgfstart.search(sgfdata)
+    if not match:
+        raise GoGameError("No SGF game found")
+
+    pos = match.start() + 1
+    if rootonly:
+        tokens = (_.groups() for _ in _sgftoken.finditer(sgfdata, pos))
+    else:
+        tokens = _sgftoken.findall(sgfdata, pos)
+
+    node = -1
+    for delimiter, identifier, value, others, junk in tokens:
+        if identifier:
+            # Old SGF versions used long identifiers, such as AddBlack for AB
+            yield node, identifier.translate(None, _lowercase), value, others
+        elif delimiter == ';':
+            node += 1
+        elif delimiter == ')':
+            return
+        elif junk:
+            raise GoGameError("Malformed SGF data near '%s'" % junk)
+
+
+def read_header(sgfdata):
+    '''Read the root node properties of raw SGF data, reading nothing past it.
+        Much faster than a full parse, meant for filtering games
+        Return a dict of property identifier: value, as text with escapes and
+        whitespace handled as gomill does. For multi-valued properties,
+        only the first value is kept
+    '''
+    header = {}
+    for node, identifier, value, _ in _sgfnodes(sgfdata, rootonly=True):
+        if node > 0:
+            break
+        if identifier not in header:
+            value = _sgfescape.sub(lambda m: m.group(2) or "", value)
+            header[identifier] = _sgfspaces.sub(" ", value)
+    return header
+
+
+def read_moves(sgfdata, size):
+    '''Read the setup stones and main line moves of raw SGF data
+        Return a tuple (setup, moves). <setup> is a list of (color, (row, col))
+        tuples of root AB, AW, and AE points, in that order, EMPTY for AE.
+        <moves> is a list of (color, (row, col)) tuples, or (color, None) for
+        passes. Same results and errors as gomill's get_setup_and_moves()
+    '''
+    points = _points(size)
+    setup = {}
+    moves = []
+    lastnode = -1
+    for node, identifier, value, others in _sgfnodes(sgfdata):
+        if identifier == 'B' or identifier == 'W':
+            point = points[value] if value in points else parse_point(value, size)
+            if node != lastnode:
+                moves.append((_sgfcolors[identifier], point))
+                lastnode = node
+            elif identifier == 'B':
+                moves[-1] = (BLACK, point)  # gomill reads B before W in the same node
+
+        elif identifier in ('AB', 'AW', 'AE'):
+            if node > 0:
+                raise GoGameError("setup properties after the root node")
+            setup.setdefault(identifier, []).extend(_sgfpoints("[%s]%s" % (value, others), size))
+
+    if setup.get('AB') or setup.get('AW'):
+        if lastnode == 0 and moves:
+            raise GoGameError("mixed setup and moves in root node")
+        return ([(BLACK, _) for _ in setup.get('AB', [])] +
+                [(WHITE, _) for _ in setup.get('AW', [])] +
+                [(EMPTY, _) for _ in setup.get('AE', [])]), moves
+
+    return [], moves
+
+
+_pointsmaps = {}
+
+
+def _points(size):
+    '''Return a dict of raw SGF point: parse_point() of all valid points and
+        passes of a <size> board. Memoized
+    '''
+    points = _pointsmaps.get(size)
+    if points is None:
+        points = _pointsmaps[size] = {"": None}
+        if size <= 19:
+            points["tt"] = None
+        for row in xrange(size):
+            for col in xrange(size):
+                points[format_point((row, col), size)] = (row, col)
+    return points
+
+
+def parse_point(value, size):
+    '''Convert a raw SGF point to (row, col), row 0 being the bottom line,
+        or None for passes
+    '''
+    if value == "" or (value == "tt" and size <= 19):
+        return None
+    if len(value) != 2:
+        raise GoGameError("Invalid SGF point: %s" % value)
+    col = ord(value[0]) - 97
+    row = size - 1 - (ord(value[1]) - 97)
+    if not (0 <= row < size and 0 <= col < size):
+        raise GoGameError("SGF point out of board: %s" % value)
+    return row, col
+
+
+def format_point(coord, size):
+    '''Convert (row, col) to a raw SGF point, the inverse of parse_point()'''
+    if coord is None:
+        return "tt" if size <= 19 else ""
+    row, col = coord
+    return chr(97 + col) + chr(97 + size - 1 - row)
+
+
+def _sgfpoints(values, size):
+    '''Yield the points of raw <values> of a point list property, expanding
+        compressed "aa:cc" rectangles
+    '''
+    for value in _sgfvalues.findall(values):
+        if ':' not in value:
+            point = parse_point(value, size)
+            if point is not None:
+                yield point
+            continue
+        first, last = [parse_point(_, size) for _ in value.split(':', 1)]
+        if first is None or last is None:
+            raise GoGameError("Invalid SGF point rectangle: %s" % value)
+        for row in xrange(min(first[0], last[0]), max(first[0], last[0]) + 1):
+            for col in xrange(min(first[1], last[1]), max(first[1], last[1]) + 1):
+                yield row, col
+
+
+_zobristkeys = {}
+
+
+def zobrist(size):
+    '''Return the (points, 3) uint64 array of Zobrist keys of a <size> board,
+        by point index and color code. Keys of empty points are zero, so the
+        hash of a board is the XOR of the keys of its stones
+        Keys are the same on every run, as hashes are stored. Memoized
+    '''
+    keys = _zobristkeys.get(size)
+    if keys is None:
+        rand = numpy.random.RandomState(size)
+        keys = numpy.zeros((size * size, 3), dtype=numpy.uint64)
+        keys[:, 1:] = numpy.frombuffer(rand.bytes(size * size * 2 * 8), dtype='<u8').reshape(-1, 2)
+        keys.flags.writeable = False
+        keys = _zobristkeys[size] = keys
+    return keys
+
+
+def hash_boards(boards):
+    '''Return the Zobrist hashes of a (count, size, size) array of boards'''
+    count, size = boards.shape[:2]
+    keys = zobrist(size)[numpy.arange(size * size), boards.reshape(count, -1)]
+    return numpy.bitwise_xor.reduce(keys, axis=1)
+
+
+_patternkeys = {}
+
+
+def pattern_zobrist(size):
+    '''Return the (points, 4) uint64 array of Zobrist keys of a <size> local
+        pattern, by point index and color code, including OFFBOARD. Memoized
+    '''
+    keys = _patternkeys.get(size)
+    if keys is None:
+        rand = numpy.random.RandomState(1000 + size)
+        keys = numpy.frombuffer(rand.bytes(size * size * 4 * 8), dtype='<u8').reshape(-1, 4).copy()
+        keys[:, 0] = 0
+        keys.flags.writeable = False
+        keys = _patternkeys[size] = keys
+    return keys
+
+
+def hash_patterns(boards, points, size=PATTERN_SIZE):
+    '''Return the hashes of the local patterns of a (count, boardsize,
+        boardsize) array of <boards>, each the <size> square area centered at
+        the point of same index in <points>
+        Hashes are canonical: the smallest of the hashes of the 8 symmetries
+        of each pattern, so rotated and reflected patterns have the same hash
+    '''
+    count, boardsize = boards.shape[:2]
+    radius = size // 2
+    padded = numpy.empty((count, boardsize + 2 * radius, boardsize + 2 * radius), dtype=numpy.uint8)
+    padded.fill(OFFBOARD)
+    padded[:, radius:radius + boardsize, radius:radius + boardsize] = boards
+
+    rows, cols = divmod(numpy.asarray(points, dtype=int), boardsize)
+    drows, dcols = divmod(numpy.arange(size * size), size)
+    patterns = padded[numpy.arange(count)[:, numpy.newaxis],
+                      rows[:, numpy.newaxis] + drows,
+                      cols[:, numpy.newaxis] + dcols]
+
+    # (count, symmetries, points) keys of each point of the transformed patterns
+    keys = pattern_zobrist(size)[numpy.arange(size * size), patterns[:, geometry.symmetries(size)]]
+    return numpy.bitwise_xor.reduce(keys, axis=2).min(axis=1)
+
+
+def fingerprint(initialboard, moves):
+    '''Return the fingerprint of a game, a hex digest of the (size, size)
+        <initialboard> array and all <moves>, as (color, (row, col)) tuples
+        It is the same for all 8 symmetries of the game: the smallest of the
+        digests of each rotated or reflected game
+    '''
+    size = initialboard.shape[0]
+    npoints = size * size
+    symmetries = geometry.symmetries(size)
+
+    # Index of each point in each transformed board, passes being npoints
+    transformed = numpy.hstack((numpy.argsort(symmetries, axis=1),
+                                numpy.full((8, 1), npoints, dtype=int)))
+
+    colors = numpy.array([COLORS.index(color) for color, _ in moves], dtype=numpy.uint8)
+    points = numpy.array([npoints if coord is None else coord[0] * size + coord[1]
+                          for _, coord in moves], dtype=int)
+    boards = initialboard.ravel()[symmetries]
+    points = transformed[:, points].astype('<u2')
+
+    return min(hashlib.sha1(chr(size) + boards[s].tostring() + colors.tostring() +
+                            points[s].tostring()).hexdigest()
+               for s in xrange(8))
+
+
+_patterncodes = {'.': 0, ' ': 0, '#': 1, 'x': 1, 'o': 2, '-': OFFBOARD}
+
+
+def parse_pattern(text):
+    '''Return the (PATTERN_SIZE, PATTERN_SIZE) array of color codes of a local
+        pattern in <text>, rows separated by '/' or newlines. Points are '.'
+        for empty, '#' or 'x' for black, 'o' for white and '-' for off-board
+    '''
+    rows = [_ for _ in re.split(r'[/\n]', text.strip('/\n')) if _]
+    if len(rows) != PATTERN_SIZE or any(len(_) != PATTERN_SIZE for _ in rows):
+        raise GoGameError("Pattern must be %d rows of %d points" % (PATTERN_SIZE, PATTERN_SIZE))
+    try:
+        return numpy.array([[_patterncodes[_] for _ in row.lower()] for row in rows], dtype=numpy.uint8)
+    except KeyError as e:
+        raise GoGameError("Invalid pattern point: %r" % e.args[0])
+
+
+def describe(header):
+    '''Return a description of a game from its <header> root properties:
+        player names and ranks, game result and date. Missing ones are None
+    '''
+    return "%s(%s) vs %s(%s) %s %s" % (header.get("PB"),
+                                       header.get("BR"),
+                                       header.get("PW"),
+                                       header.get("WR"),
+                                       header.get("RE"),
+                                       header.get("DT"),)
+
+
 class GoGame(object):
     '''Class representing a Go game
         Attributes populated after loading the SGF file (when object is instantiated):
-        - sgffile: Full path to the SGF source file
-        - sgfgame: Gomill Sgf_game instance
-        - header: Root of sgfgame containing game headers
+        - sgffile: Full path to the SGF source file. If <sgfdata> is passed to
+            constructor, the SGF content is read from it instead, and <sgffile>
+            is only used as the game name in messages
+        - sgfdata: Raw SGF content
+        - header: dict of root node properties, as read by read_header()
         - size: Board size
         - winner: color of game winner
+        - description: String of player names and ranks, game result and date
+            See describe()
 
         Attributes populated after .setup():
-        - id: 12 char string uniquely identifying the game (letter coords of moves 20, 40, 60, 31, 51, 71)
-            may be passed to constructor
-        - description: String of player names and ranks, game result and date
-            requires all such headers to be present
+        - id: 12 char string identifying the game (letter coords of moves 20, 40, 60, 31, 51, 71)
+            may be passed to constructor. Library games sharing the same one
+            get a numeric suffix on import
+        - fingerprint: digest of all moves, the same for rotated and mirrored
+            copies of the game. See fingerprint()
         - initialboard: Board instance of initial board layout. Empty if game has no handicap
         - moves: List of all moves. Each move is a (color, (row, col)) tuple
-        - sgfboard: Gomill Board instance after initial setup and before first move
+        - nummoves: Number of moves
 
         Attributes populated after .play()
-        - boards: List of boards
+        - boards: BoardSequence of boards, one after each move
+        Zobrist hashes of the boards are returned by .hashes(), and of the
+        local pattern of each move by .patterns()
+
+        Played boards are cached in a pack, each game as a single record. The
+        storage mode is selected by the board_cache option:
+        - 'boards': all boards, including the initial board. See pack_boards()
+        - 'moves': initial board, moves and points captured by each move,
+            boards are rebuilt by replay_moves(). Much smaller but slower
 
     '''
-    def __init__(self, sgffile, id="", autosetup=True, autoplay=True):
+    def __init__(self, sgffile, id="", autosetup=True, autoplay=True, sgfdata=None):
         self.sgffile = sgffile
-        self.sgfgame = self._sgfgame(self.sgffile)
-        self.header = self.sgfgame.get_root()
-        self.size = self.sgfgame.get_size()
+        if sgfdata is None:
+            with open(self.sgffile, 'rb') as fp:
+                sgfdata = fp.read()
+        self.sgfdata = sgfdata
+        self.header = read_header(sgfdata)
 
         try:
-            self.winner = self.sgfgame.get_winner()
-        except ValueError as e:
-            raise GoGameError("No winner: %s" % e)
+            self.size = int(self.header.get('SZ', 19))
+        except ValueError:
+            raise GoGameError("Invalid board size: %s" % self.header['SZ'])
+        if not 1 <= self.size <= 26:
+            raise GoGameError("Board size out of range: %d" % self.size)
+
+        self.winner = {'b': BLACK, 'w': WHITE}.get(self.header.get('RE', "")[:1].lower())
+        self.description = describe(self.header)
 
         self.id = id
-        self.description = ""
+        self.fingerprint = ""
         self.initialboard = None
         self.moves = []
-        self.sgfboard = None
+        self.nummoves = 0
         if autosetup:
             self.setup()
 
         self.boards = []
+        self._hashes = None
         if autoplay:
             self.play()
 
-    def _sgfgame(self, sgffile):
-        with open(sgffile, 'r') as fp:
-            try:
-                return gomill.sgf.Sgf_game.from_string(fp.read())
-            except ValueError as e:
-                raise GoGameError(e)
-
     def _gameid(self, moves, size):
         id = ""
         maxmoves = len(moves)
         for move in [20, 40, 60, 31, 51, 71]:
             if move <= maxmoves:
-                id += gomill.sgf_properties.serialise_go_point(moves[move-1][1], size)
+                id += format_point(moves[move-1][1], size)
             else:
                 id += "--"
         return id
 
     def setup(self):
-        sgfmovemap = {
-            None  : EMPTY,
-            "b"   : BLACK,
-            "w"   : WHITE,
-        }
+        setup, moves = read_moves(self.sgfdata, self.size)
+        self.moves = tuple(moves)
+        self.nummoves = len(self.moves)
 
-        try:
-            self.sgfboard, sgfmoves = gomill.sgf_moves.get_setup_and_moves(self.sgfgame)
-            self.moves = tuple((sgfmovemap[color], coord) for color, coord in sgfmoves)
-            self.initialboard = Board(self.size, self.sgfboard.copy().board)   # FIXME: Boards are no longer compatible!
-            if not self.id:
-                self.id = self._gameid(self.moves, self.size)
-            self.description = "%s(%s) vs %s(%s) %s %s" % (self.header.get("PB"),
-                                                           self.header.get("BR"),
-                                                           self.header.get("PW"),
-                                                           self.header.get("WR"),
-                                                           self.header.get("RE"),
-                                                           self.header.get("DT"),)
-        except ValueError as e:
-            raise GoGameError(e)
-
-    def play(self):
+        self.initialboard = Board(self.size)
+        for color, coord in setup:
+            self.initialboard.set(color, *coord)
+        if setup and Engine(self.size, self.initialboard.board).surrounded():
+            raise GoGameError("setup position not legal")
+
+        if not self.id:
+            self.id = self._gameid(self.moves, self.size)
+        self.fingerprint = fingerprint(self.initialboard.board, self.moves)
+
+    def play(self, refresh=False):
+        '''Load boards from cache, or play the game and cache them. If
+            <refresh>, always play it, replacing any cached boards
+        '''
         if not self.id:
             self.setup()
 
-        boardfile = os.path.join(g.USERDIR, 'boards', self.id[:2], "%s.json" % self.id)
+        if g.options.board_cache == 'moves':
+            cache, dump = pack.get_pack(g.MOVESFILE), pack_moves
+        else:
+            cache, dump = pack.get_pack(g.BOARDSFILE), pack_boards
+
+        self._hashes = None
+        data = None if refresh else cache.view(self.id)
+        if data is None:
+            data = dump(self._play(), self.moves)
+            cache.put(self.id, data)
+
+        self.boards = BoardSequence(data)
+        self.initialboard = self.boards.initialboard
+
+    def hashes(self):
+        '''Return an array of the Zobrist hashes of the initial board and the
+            board after each move. Known if the game was just played by the
+            engine, otherwise computed from the cached boards
+        '''
+        if self._hashes is None:
+            if not self.boards:
+                self.play()
+            boards = self.boards.array()
+            self._hashes = numpy.concatenate((hash_boards(self.initialboard.board[numpy.newaxis]),
+                                              hash_boards(boards) if len(boards) else []))
+        return self._hashes
+
+    def patterns(self):
+        '''Return a (moves, hashes) tuple of arrays of the move numbers and
+            local pattern hashes of all moves but passes. Patterns are centered
+            at the played stone, on the board after the move
+        '''
+        if not self.boards:
+            self.play()
+        played = [(m, coord) for m, (_, coord) in enumerate(self.moves, 1) if coord is not None]
+        if not played:
+            return numpy.zeros(0, dtype=numpy.uint16), numpy.zeros(0, dtype=numpy.uint64)
+        moves = numpy.array([_[0] for _ in played], dtype=numpy.uint16)
+        points = [row * self.size + col for _, (row, col) in played]
+        return moves, hash_patterns(self.boards.array()[moves.astype(int) - 1], points)
+
+    def _play(self):
+        '''Play the SGF game, returning a (moves + 1, size, size) array of color
+            codes of the initial board and the board after each move
+            Also keeps the Zobrist hash of each board, updated by the engine
+        '''
+        engine = Engine(self.size, self.initialboard.board)
+        boards = numpy.empty((len(self.moves) + 1, self.size * self.size), dtype=numpy.uint8)
+        hashes = numpy.empty(len(self.moves) + 1, dtype=numpy.uint64)
+        boards[0] = engine.board
+        hashes[0] = engine.hash
+
+        for m, move in enumerate(self.moves, 1):
+            color, coord = move
+            if coord is not None:
+                try:
+                    engine.play(coord[0], coord[1], COLORS.index(color))
+                except GoGameError as e:
+                    raise GoGameError("Invalid move #%d: %s[%s]: %s" % (
+                        m,
+                        color.upper(),
+                        format_point(coord, self.size),
+                        e))
+            boards[m] = engine.board
+            hashes[m] = engine.hash
+
+        self._hashes = hashes
+        return boards.reshape(-1, self.size, self.size)
+
+
+_boardsheader = struct.Struct('<4sBH')  # magic, board size, number of boards
+_movesheader  = struct.Struct('<4sBHH')  # magic, board size, number of moves, number of captures
+
+
+def pack_boards(boards, moves=None):
+    '''Serialize a (count, size, size) array of color codes. <moves> is unused
+        As codes fit in 2 bits, 4 points are packed per byte. The result is
+        a small header followed by the packed points, of all boards in order
+    '''
+    count, size, _ = boards.shape
+    points = boards.ravel()
+    points = numpy.concatenate((points, numpy.zeros(-len(points) % 4, numpy.uint8))).reshape(-1, 4)
+    packed = (points[:, 0] << 6) | (points[:, 1] << 4) | (points[:, 2] << 2) | points[:, 3]
+    return _boardsheader.pack('GOB2', size, count) + packed.tostring()
 
-        try:
-            with open(boardfile, 'r') as fp:
-                # id, board size, description, moves count, initial board, moves list
-                _, size, _, _, initialboard, moves = json.load(fp)
-
-            self.initialboard = Board.from_ascii(size, initialboard)
-
-            # play index, move, ascii board
-            for _, _, asciiboard in moves:
-                self.boards.append(Board.from_ascii(size, asciiboard))
-
-        except IOError:
-            # Play the SGF game
-            jsonplays = []
-            sgfboard = self.sgfboard.copy()
-
-            for m, move in enumerate(self.moves, 1):
-                color, coord = move
-                if coord is not None:
-                    row, col = coord
-                    try:
-                        sgfboard.play(row, col, color)
-                    except Exception:
-                        raise GoGameError("Invalid move #%d: %s[%s]" % (
-                            m,
-                            color.upper(),
-                            gomill.sgf_properties.serialise_go_point(coord, self.size)))
-
-                board = Board(self.size, sgfboard.copy().board)  # FIXME: Boards are no longer compatible!
-                self.boards.append(board)
-                jsonplays.append('[%d, ["%s", %s], %s]' % (m,
-                                                          color,
-                                                          'null' if coord is None else list(coord),
-                                                          board.dumpjson()))
-
-            # Save the boards to JSON
-            utils.safemakedirs(os.path.dirname(boardfile))
-            with open(boardfile, 'w') as fp:
-                fp.write('["%s", %d, "%s", %d, %s, [\n%s\n]]\n' % (
-                   self.id,
-                   self.size,
-                   self.description,
-                   len(self.moves),
-                   self.initialboard.dumpjson(),
-                   ",\n".join(jsonplays)))
+
+def unpack_boards(data):
+    '''Deserialize <data> created by pack_boards() to a (count, size, size)
+        array of color codes. <data> can be any string or buffer, such as a
+        Pack view, and is read in place, then unpacked in a single numpy pass
+    '''
+    magic, size, count = _boardsheader.unpack_from(data)
+    if magic != 'GOB2':
+        raise GoGameError("Invalid boards data")
+    packed = numpy.frombuffer(data, numpy.uint8, offset=_boardsheader.size)
+    points = (packed[:, numpy.newaxis] >> numpy.array([6, 4, 2, 0], numpy.uint8)) & 3
+    return points.ravel()[:count * size * size].reshape(count, size, size)
+
+
+def pack_moves(boards, moves):
+    '''Serialize a game as its initial board, <moves> and captured points
+        <boards> is the (moves + 1, size, size) array of the initial board and
+        the board after each move, from which captures are derived
+        The result is a header, the initial board as in pack_boards(), then
+        arrays of color code and point index of each move (-1 for passes),
+        and of move index and point index of each captured stone
+    '''
+    count, size = boards.shape[:2]
+    flat = boards.reshape(count, -1)
+    colors = numpy.array([COLORS.index(color) for color, _ in moves], numpy.uint8)
+    points = numpy.array([-1 if coord is None else coord[0] * size + coord[1] for _, coord in moves], numpy.int16)
+
+    # Stones removed by each move, including the played stone on suicides
+    placed = numpy.zeros(flat[1:].shape, dtype=bool)
+    placed[points >= 0, points[points >= 0]] = True
+    capmoves, cappoints = numpy.nonzero(((flat[:-1] != 0) | placed) & (flat[1:] == 0))
+    return ''.join((_movesheader.pack('GOM1', size, len(moves), len(capmoves)),
+                    pack_boards(boards[:1]),
+                    colors.tostring(),
+                    points.tostring(),
+                    capmoves.astype(numpy.uint16).tostring(),
+                    cappoints.astype(numpy.int16).tostring()))
+
+
+def unpack_moves(data):
+    '''Deserialize <data> created by pack_moves() to a tuple of arrays:
+        initial board, move colors, move points, capture moves, capture points
+    '''
+    magic, size, moves, captures = _movesheader.unpack_from(data)
+    if magic != 'GOM1':
+        raise GoGameError("Invalid moves data")
+    offset = _movesheader.size
+    boardsize = _boardsheader.size + (size * size + 3) // 4
+    initialboard = unpack_boards(data[offset:offset + boardsize])[0]
+    offset += boardsize
+    arrays = []
+    for dtype, count in [(numpy.uint8, moves), (numpy.int16, moves), (numpy.uint16, captures), (numpy.int16, captures)]:
+        arrays.append(numpy.frombuffer(data, dtype, count, offset))
+        offset += arrays[-1].nbytes
+    return (initialboard,) + tuple(arrays)
+
+
+def replay_moves(initialboard, colors, points, capmoves, cappoints):
+    '''Rebuild the boards of a game from the arrays returned by unpack_moves()
+        Return a (moves + 1, size, size) array of the initial board and the
+        board after each move. No rules are applied: for each board and point,
+        the color is the one set by the latest move that placed or captured a
+        stone on that point, all found in a single vectorized pass
+    '''
+    size = initialboard.shape[0]
+    moves = len(colors)
+    placed = points >= 0
+
+    # Color set by each event, and the index of the event that last set each point
+    values = numpy.zeros((moves + 1, size * size), numpy.uint8)
+    values[0] = initialboard.ravel()
+    values[1:][placed, points[placed]] = colors[placed]
+    values[capmoves + 1, cappoints] = 0  # EMPTY, overriding the played stone on suicides
+    latest = numpy.zeros((moves + 1, size * size), numpy.int32)
+    latest[1:][placed, points[placed]] = numpy.nonzero(placed)[0] + 1
+    latest[capmoves + 1, cappoints] = capmoves + 1
+    numpy.maximum.accumulate(latest, axis=0, out=latest)
+
+    return values[latest, numpy.arange(size * size)].reshape(moves + 1, size, size)
+
+
+class BoardSequence(object):
+    '''Lazy sequence of the Boards of a game, one after each move
+        Boards are built from <data>, a record created by pack_boards() or
+        pack_moves(), only when iterated or indexed, so a game is never held
+        in memory as a whole. Iteration builds <chunksize> boards at a time,
+        and only the last <snapshots> boards accessed by index are kept.
+        Any board, including the last, is built directly by index, without
+        building all the ones before it
+    '''
+
+    chunksize = 32
+
+    def __init__(self, data, snapshots=8):
+        self.data = data
+        self.snapshots = snapshots
+        self._snapshots = collections.OrderedDict()
+
+        if data[:4] == 'GOM1':
+            (self._initial, self._colors, self._points,
+             self._capmoves, self._cappoints) = unpack_moves(data)
+            self.size = self._initial.shape[0]
+            self.count = len(self._colors) + 1
+        else:
+            magic, self.size, self.count = _boardsheader.unpack_from(data)
+            if magic != 'GOB2':
+                raise GoGameError("Invalid boards data")
+            self._initial = None
+
+        self.initialboard = Board(self.size, self._board(0))
+
+    def __len__(self):
+        return self.count - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("board index out of range")
+
+        board = self._snapshots.pop(index, None)
+        if board is None:
+            board = Board(self.size, self._board(index + 1))
+            if len(self._snapshots) >= self.snapshots:
+                self._snapshots.popitem(last=False)
+        self._snapshots[index] = board
+        return board
+
+    def array(self):
+        '''Return all boards as a single read-only (moves, size, size) array'''
+        if self._initial is None:
+            return self._unpack(1, self.count - 1)
+        boards = replay_moves(self._initial, self._colors, self._points, self._capmoves, self._cappoints)[1:]
+        boards.flags.writeable = False
+        return boards
+
+    def __iter__(self):
+        if self._initial is None:
+            for start in xrange(1, self.count, self.chunksize):
+                for board in self._unpack(start, min(self.chunksize, self.count - start)):
+                    yield Board(self.size, board)
+            return
+
+        board = self._initial
+        for start in xrange(0, self.count - 1, self.chunksize):
+            end = start + self.chunksize
+            first, last = numpy.searchsorted(self._capmoves, [start, end])
+            boards = replay_moves(board,
+                                  self._colors[start:end],
+                                  self._points[start:end],
+                                  self._capmoves[first:last] - start,
+                                  self._cappoints[first:last])
+            boards.flags.writeable = False
+            for board in boards[1:]:
+                yield Board(self.size, board)
+            board = boards[-1]
+
+    def _board(self, index):
+        '''Return board <index> of record, 0 being the initial board'''
+        if self._initial is None:
+            return self._unpack(index)[0]
+
+        # Sort key of the latest event on each point up to move <index>,
+        # captures after placements of the same move, and its color
+        colors, points = self._colors[:index], self._points[:index]
+        moves = numpy.flatnonzero(points >= 0)
+        captures = numpy.searchsorted(self._capmoves, index)
+        latest = numpy.zeros(self.size * self.size, numpy.int32)
+        numpy.maximum.at(latest, points[moves], 2 * moves + 2)
+        numpy.maximum.at(latest, self._cappoints[:captures], 2 * self._capmoves[:captures].astype(numpy.int32) + 3)
+
+        board = self._initial.ravel().copy()
+        placed = (latest > 0) & (latest % 2 == 0)
+        board[placed] = colors[latest[placed] // 2 - 1]
+        board[latest % 2 == 1] = 0
+        board.flags.writeable = False
+        return board.reshape(self.size, self.size)
+
+    def _unpack(self, index, count=1):
+        '''Unpack <count> boards of a pack_boards() record, starting at <index>'''
+        npoints = self.size * self.size
+        first, skip = divmod(index * npoints, 4)
+        length = (skip + count * npoints + 3) // 4
+        packed = numpy.frombuffer(self.data, numpy.uint8, length, _boardsheader.size + first)
+        points = (packed[:, numpy.newaxis] >> numpy.array([6, 4, 2, 0], numpy.uint8)) & 3
+        points.flags.writeable = False
+        return points.ravel()[skip:skip + count * npoints].reshape(count, self.size, self.size)
+
+
+class Engine(object):
+    '''Go rules engine, playing moves on a board of color codes
+        Same rules as gomill's Board.play(): captures opponent stones left
+        without liberties, allows suicide (removing the played group if it
+        captures nothing) and does not enforce ko, only reports the point
+        forbidden by simple ko in .ko after each move
+
+        Groups are kept in a union-find forest, each root holding the group
+        stone count and its pseudo-liberties: the number of (stone, empty
+        neighbour) pairs, which is zero only if the group has no liberties.
+        Stones of each group are also linked in a circular list, so a move
+        costs O(size of groups it touches), with no board scans
+
+        <board> is the initial (size, size) array of color codes, if any.
+        The current position is kept in .board, a flat numpy array; use
+        snapshot() for an immutable (size, size) copy. Its Zobrist hash,
+        updated on every stone placed or removed, is kept in .hash
+    '''
+
+    def __init__(self, size, board=None):
+        self.size = size
+        self.neighbours = geometry.neighbours(size)
+        self.board = numpy.zeros(size * size, dtype=numpy.uint8)
+        self.hash = 0
+        self.ko = None
+        self._keys = zobrist(size).tolist()
+
+        npoints = size * size
+        self._colors  = [0] * npoints      # Same as .board, faster to read from Python
+        self._parent  = range(npoints)
+        self._next    = range(npoints)     # Next stone in group, circular
+        self._stones  = [0] * npoints      # Stone count, by group root
+        self._liberties = [0] * npoints    # Pseudo-liberties, by group root
+
+        if board is not None:
+            for point in numpy.flatnonzero(board):
+                self._place(int(point), int(board.flat[point]))
+
+    def play(self, row, col, color):
+        '''Play a stone of color code <color> at (<row>, <col>)
+            Return the list of point indexes of all stones captured
+        '''
+        if not (0 <= row < self.size and 0 <= col < self.size):
+            raise GoGameError("Point %r is outside board" % ((row, col),))
+        point = row * self.size + col
+        if self._colors[point]:
+            raise GoGameError("Point %r is not empty" % ((row, col),))
+
+        group = self._place(point, color)
+
+        captured = []
+        for neighbour in self.neighbours[point]:
+            ncolor = self._colors[neighbour]
+            if ncolor and ncolor != color:
+                root = self._find(neighbour)
+                if self._liberties[root] == 0:
+                    captured.extend(self._remove(root))
+
+        group = self._find(group)
+        self.ko = None
+        if not captured:
+            if self._liberties[group] == 0:
+                captured = self._remove(group)  # Suicide
+        elif len(captured) == 1 and self._stones[group] == 1:
+            # Single stone capturing a single stone, and that was surrounded
+            # before the capture, as it has one liberty now: the captured point
+            if self._liberties[group] == 1:
+                self.ko = captured[0]
+        return captured
+
+    def surrounded(self):
+        '''Return True if any group has no liberties. Positions created only
+            by play() never have such groups, but setup stones may
+        '''
+        return any(self._liberties[self._find(point)] == 0
+                   for point, color in enumerate(self._colors) if color)
+
+    def snapshot(self):
+        '''Return the current position as a read-only (size, size) array'''
+        board = self.board.reshape(self.size, self.size).copy()
+        board.flags.writeable = False
+        return board
+
+    def _find(self, point):
+        parent = self._parent
+        while parent[point] != point:
+            parent[point] = point = parent[parent[point]]  # Path halving
+        return point
+
+    def _place(self, point, color):
+        '''Add a stone to the board, merging it with its neighbour groups
+            Return its group root
+        '''
+        self._colors[point] = color
+        self.board[point] = color
+        self.hash ^= self._keys[point][color]
+        self._parent[point] = point
+        self._next[point] = point
+        self._stones[point] = 1
+        self._liberties[point] = 0
+
+        root = point
+        for neighbour in self.neighbours[point]:
+            if self._colors[neighbour]:
+                self._liberties[self._find(neighbour)] -= 1
+            else:
+                self._liberties[point] += 1
+
+        for neighbour in self.neighbours[point]:
+            if self._colors[neighbour] == color:
+                other = self._find(neighbour)
+                if other != root:
+                    root = self._union(root, other)
+        return root
+
+    def _union(self, a, b):
+        if self._stones[a] < self._stones[b]:
+            a, b = b, a
+        self._parent[b] = a
+        self._stones[a] += self._stones[b]
+        self._liberties[a] += self._liberties[b]
+        self._next[a], self._next[b] = self._next[b], self._next[a]  # Splice stone lists
+        return a
+
+    def _remove(self, root):
+        '''Remove all stones of group <root>, return their points'''
+        points = [root]
+        point = self._next[root]
+        while point != root:
+            points.append(point)
+            point = self._next[point]
+
+        keys = self._keys
+        for point in points:
+            self.hash ^= keys[point][self._colors[point]]
+            self._colors[point] = 0
+        self.board[points] = 0
+
+        for point in points:
+            for neighbour in self.neighbours[point]:
+                if self._colors[neighbour]:
+                    self._liberties[self._find(neighbour)] += 1
+        return points
 
 
 class Board(object):
+    '''Board position. <board> is a (size, size) numpy array of color codes,
+        indexed by (row, col). Boards loaded from cache are read-only views
+    '''
 
-    _to_ascii = {
-        EMPTY : " ",
-        BLACK : "x",
-        WHITE : "o",
-    }
+    _to_ascii = " xo"  # by color code
+
+    _from_ascii = numpy.zeros(256, dtype=numpy.uint8)  # by character ordinal
+    _from_ascii[[ord(_) for _ in _to_ascii]] = range(len(_to_ascii))
 
     @classmethod
     def from_ascii(cls, size, asciiboard):
-        board = list(reversed(asciiboard))
-        return cls(size, board)
+        chars = numpy.frombuffer("".join(reversed(asciiboard)), dtype=numpy.uint8)
+        return cls(size, cls._from_ascii[chars].reshape(size, size))
+
+    @classmethod
+    def mask(cls, size, points):
+        '''Return a (size, size) boolean array, True for <points>, to be used as
+            a region in stonecount() and as an index of board arrays
+        '''
+        mask = numpy.zeros((size, size), dtype=bool)
+        if points:
+            rows, cols = zip(*points)
+            mask[rows, cols] = True
+        return mask
 
     def __init__(self, size=0, board=None):
         self.size = size
 
         if board is None:
-            self.board = []
-            for _ in range(self.size):
-                self.board.append([EMPTY] * self.size)
+            self.board = numpy.zeros((self.size, self.size), dtype=numpy.uint8)
         else:
             self.board = board
 
     def get(self, row, col):
-        return self.board[row][col]
+        return COLORS[self.board[row, col]]
 
     def set(self, color, row, col):
-        self.board[row][col] = color
+        self.board[row, col] = COLORS.index(color)
 
     def points(self):
-        for row in xrange(self.size):
-            for col in xrange(self.size):
-                yield self.board[row][col]
+        for code in self.board.ravel().tolist():
+            yield COLORS[code]
 
     def dumpjson(self, indent=0):
         spc = indent * " "
@@ -218,45 +898,33 @@ class Board(object):
 
     def asciilines(self):
         for row in xrange(self.size - 1, -1, -1):
-            line = ""
-            for col in xrange(self.size):
-                line += self._to_ascii[self.board[row][col]]
-            yield line
+            yield "".join(self._to_ascii[_] for _ in self.board[row])
 
     def ascii(self, black="#", white="o", empty=" "):
-        # TODO: could be vastly improved by exploiting board internal format
-
-        mapping = {
-            EMPTY : " " + empty,
-            BLACK : " " + black,
-            WHITE : " " + white,
-            }
-
-        def format_pt(row, col):
-            return mapping.get(self.get(row, col), " ?")
-
-        def grid(point_formatter, size):
-            column_header_string = " ".join("%02d" % i for i in xrange(size))
-            result = []
-            if size > 9:
-                rowstart = "%2d "
-                padding = " "
-            else:
-                rowstart = "%d "
-                padding = ""
-            for row in range(size-1, -1, -1):
-                result.append(rowstart % (row) +
-                              " ".join(point_formatter(row, col)
-                              for col in range(size)))
-            result.append(padding + "  " + column_header_string)
-            return result
-
-        return "\n".join(grid(format_pt, self.size))
-
-    def stonecount(self):
-        chars = ''.join(self.board)
-        return (chars.count(BLACK),
-                chars.count(WHITE))
+        mapping = (" " + empty, " " + black, " " + white)  # by color code
+
+        if self.size > 9:
+            rowstart = "%2d "
+            padding = " "
+        else:
+            rowstart = "%d "
+            padding = ""
+
+        result = []
+        for row in xrange(self.size - 1, -1, -1):
+            result.append(rowstart % row + " ".join(mapping[_] for _ in self.board[row].tolist()))
+        result.append(padding + "  " + " ".join("%02d" % i for i in xrange(self.size)))
+        return "\n".join(result)
+
+    def stonecount(self, region=None):
+        '''Return a (blacks, whites) tuple of the number of stones in board, or
+            only in <region>, a boolean mask such as from mask() or any other
+            index of board arrays
+        '''
+        points = self.board if region is None else self.board[region]
+        counts = numpy.bincount(points.ravel(), minlength=len(COLORS))
+        return (int(counts[1]),
+                int(counts[2]))
 
     @classmethod
     def paintboard(cls, size, width=1, points=None):
@@ -276,6 +944,10 @@ class Board(object):
 
     @classmethod
     def perimeters(cls, size, width=1, maxperimeters=0, corner=(0,0)):
+        '''Return a list of concentric perimeters of <width>, from the edge to
+            the center, each a list of (row, col) points in drawing order.
+            For region masks and counts, see geometry.perimeters()
+        '''
         if width <= 0:
             return []
 
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2014 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+'''Persistent Library index, an SQLite database of games and their headers'''
+
+import os
+import logging
+import json
+import sqlite3
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+
+class LibraryIndex(object):
+    '''Index of games in Library, kept in an SQLite database at <path>
+        Each game entry is a dict with keys:
+        - id: Game ID
+        - path: Path of the SGF file the game was imported from
+        - header: dict of game root node properties, as read by gogame.read_header()
+        - moves: Number of moves
+        - winner: Color of game winner
+        - size: Board size
+        - fingerprint: Game fingerprint, identical for duplicate games
+
+        Also holds the manifest of source games read by import: the outcome
+        of each game, either 'imported' or the reason it was ignored, and
+        which source files were completely processed. Sources and games are
+        identified by path and a (size, mtime) stamp, so changed ones are
+        read again
+    '''
+
+    version = 3
+    columns = ('id', 'path', 'header', 'moves', 'winner', 'size', 'fingerprint')
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()  # SQLite connections must not be shared with forked processes
+        self.created = False  # If database was created or reset, and is empty
+
+        utils.safemakedirs(os.path.dirname(self.path))
+        self.db = sqlite3.connect(self.path)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.executescript('''
+                DROP TABLE IF EXISTS games;
+                CREATE TABLE games (
+                    id     TEXT PRIMARY KEY,
+                    path   TEXT NOT NULL,
+                    header TEXT NOT NULL,
+                    moves  INTEGER NOT NULL,
+                    winner TEXT,
+                    size   INTEGER NOT NULL,
+                    fingerprint TEXT NOT NULL
+                );
+                CREATE INDEX games_fingerprint ON games (fingerprint);
+                DROP TABLE IF EXISTS sources;
+                CREATE TABLE sources (
+                    path   TEXT PRIMARY KEY,
+                    size   INTEGER NOT NULL,
+                    mtime  INTEGER NOT NULL
+                );
+                DROP TABLE IF EXISTS outcomes;
+                CREATE TABLE outcomes (
+                    source  TEXT NOT NULL,
+                    member  TEXT NOT NULL,
+                    size    INTEGER NOT NULL,
+                    mtime   INTEGER NOT NULL,
+                    outcome TEXT NOT NULL,
+                    gameid  TEXT,
+                    PRIMARY KEY (source, member)
+                );
+                PRAGMA user_version = %d;
+            ''' % self.version)
+            self.created = True
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+
+    def __contains__(self, gameid):
+        return self.db.execute("SELECT 1 FROM games WHERE id = ?", (gameid,)).fetchone() is not None
+
+    def add(self, entry):
+        '''Add or replace a game <entry> dict. Changes are only visible to other
+            connections after commit()
+        '''
+        self.db.execute("INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (entry['id'],
+                         entry['path'],
+                         json.dumps(entry['header'], sort_keys=True, separators=(',', ':')),
+                         entry['moves'],
+                         entry['winner'],
+                         entry['size'],
+                         entry['fingerprint']))
+
+    def get(self, gameid):
+        '''Return the game entry dict of <gameid>, or None if not in index'''
+        row = self.db.execute("SELECT * FROM games WHERE id = ?", (gameid,)).fetchone()
+        if row is not None:
+            return self._entry(row)
+
+    def gameids(self, maxgames=0):
+        '''Yield Game IDs in import order, at most <maxgames> if non-zero'''
+        for row in self.db.execute("SELECT id FROM games ORDER BY rowid LIMIT ?", (maxgames or -1,)):
+            yield row[0]
+
+    def fingerprinted(self, maxgames=0):
+        '''Yield (Game ID, fingerprint) tuples in import order, at most
+            <maxgames> if non-zero
+        '''
+        for row in self.db.execute("SELECT id, fingerprint FROM games ORDER BY rowid LIMIT ?",
+                                   (maxgames or -1,)):
+            yield row
+
+    def entries(self, maxgames=0):
+        '''Yield game entry dicts in import order, at most <maxgames> if non-zero'''
+        for row in self.db.execute("SELECT * FROM games ORDER BY rowid LIMIT ?", (maxgames or -1,)):
+            yield self._entry(row)
+
+    def fingerprints(self):
+        '''Return the set of fingerprints of all games'''
+        return set(row[0] for row in self.db.execute("SELECT fingerprint FROM games"))
+
+    def source_done(self, source, stamp):
+        '''Return True if all games in <source> with <stamp> were processed'''
+        return self.db.execute("SELECT 1 FROM sources WHERE path = ? AND size = ? AND mtime = ?",
+                               (source,) + tuple(stamp)).fetchone() is not None
+
+    def set_source_done(self, source, stamp):
+        self.db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?)", (source,) + tuple(stamp))
+
+    def outcome(self, source, member, stamp):
+        '''Return the outcome of <member> game of <source> with <stamp>, or None
+            if it was not processed yet
+        '''
+        row = self.db.execute("SELECT outcome FROM outcomes"
+                              " WHERE source = ? AND member = ? AND size = ? AND mtime = ?",
+                              (source, member) + tuple(stamp)).fetchone()
+        if row is not None:
+            return row[0]
+
+    def set_outcome(self, source, member, stamp, outcome, gameid=None):
+        self.db.execute("INSERT OR REPLACE INTO outcomes VALUES (?, ?, ?, ?, ?, ?)",
+                        (source, member) + tuple(stamp) + (outcome, gameid))
+
+    def outcomes(self, sources):
+        '''Return a dict of outcome: number of games in <sources> with that outcome'''
+        result = {}
+        for source in sources:
+            for outcome, count in self.db.execute("SELECT outcome, COUNT(*) FROM outcomes"
+                                                  " WHERE source = ? GROUP BY outcome", (source,)):
+                result[outcome] = result.get(outcome, 0) + count
+        return result
+
+    def clear(self):
+        self.db.execute("DELETE FROM games")
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _entry(self, row):
+        entry = dict(zip(self.columns, row))
+        entry['header'] = json.loads(entry['header'])
+        return entry
@@ -21,95 +21,162 @@ import os
 import logging
 import zipfile
 import tarfile
-import shutil
+import itertools
+import multiprocessing
+import functools
+import time
 
 import progressbar
 
 import globals as g
 import gogame
+import index as libindex
+import pack
+import positions as libpositions
+import openings as libopenings
 import utils
 import xzfile
 
 log = logging.getLogger(__name__)
 
+_index = None
+_positions = None
+_patterns = None
+_openings = None
+_fingerprints = set()  # Of all Library games, while importing
+
+# Reasons for not importing a game. Keys of the skip counters in import_sources()
+SKIPREASONS = ('size', 'result', 'rank', 'handicap', 'fewmoves', 'rules', 'date', 'error', 'duplicate')
+
 
 class ExtractError(Exception):
     pass
 
 
-def extract(filepath, destdir=""):
-    '''Extract a <filepath> archive to a <destdir>
+def read_archive(fileobj, filepath):
+    '''Read all SGF files in a <filepath> archive, open as <fileobj>
+        Yield a (membername, stamp, read) tuple for each game, where <stamp>
+        is a (size, mtime) tuple and <read> a function returning its SGF data.
+        Games are read sequentially and straight to memory, without extracting
+        anything to disk. Not calling <read> skips reading the game
         Raise ExtractError if <filepath> is not an archive of a supported format
     '''
 
-    if os.path.exists(destdir):
+    if zipfile.is_zipfile(filepath):
+        archive = zipfile.ZipFile(fileobj)
+        for member in archive.infolist():
+            if os.path.splitext(member.filename)[1][1:].lower() == "sgf":
+                yield (member.filename,
+                       (member.file_size, int(time.mktime(member.date_time + (0, 0, -1)))),
+                       functools.partial(archive.read, member))
         return
 
-    driver = None
-    if   zipfile.is_zipfile(filepath): driver = zipfile.ZipFile
-    elif tarfile.is_tarfile(filepath): driver = tarfile.open
-    elif  xzfile.is_xzfile (filepath): driver = xzfile.xzopen
-
-    if not driver:
+    if   tarfile.is_tarfile(filepath): archive = tarfile.open(fileobj=fileobj, mode='r|*')
+    elif  xzfile.is_xzfile (filepath): archive = xzfile.xzopen(filepath, fileobj=fileobj)
+    else:
         raise ExtractError("Invalid archive format")
 
-    log.debug("Extracting %s to %s", os.path.basename(filepath), destdir)
-    archive = driver(filepath, 'r')
-    archive.extractall(destdir)
+    for member in archive:
+        if member.isfile() and os.path.splitext(member.name)[1][1:].lower() == "sgf":
+            yield (member.name,
+                   (member.size, int(member.mtime)),
+                   archive.extractfile(member).read)
 
 
-def find_games(paths):
+def find_sources(paths):
     '''Search for SGF files and archives in <paths>'''
 
-    archivecachedir = os.path.join(g.USERDIR, 'sources')
-    utils.safemakedirs(archivecachedir)
-
     for path in paths:
         log.info("Searching for games in %s", os.path.abspath(path))
 
-        for root, dirs, files in os.walk(path):
+        if os.path.isfile(path):
+            yield path
+            continue
+
+        for root, _, files in os.walk(path):
             for name in files:
-                filepath = os.path.join(root, name)
-                ext = os.path.splitext(name)[1][1:].lower()
+                if os.path.splitext(name)[1][1:].lower() in ['sgf', 'zip', 'gz', 'bz2', 'xz']:
+                    yield os.path.join(root, name)
+
+
+def find_games(sources, manifest=None):
+    '''Read SGF games from a list of <sources> files and archives
+        Yield a (source, member, stamp, sgfdata, position) tuple for each game.
+        <source> is the full path of the source file, <member> the game path
+        inside the archive, or "" for SGF files, <stamp> a (size, mtime) tuple
+        and <position> the total size of sources read so far, suitable for
+        progress reports. After all games of a source are read, yield a
+        (source, None, stamp, None, position) tuple for the source itself
+        If <manifest> Library index is given, skip sources and games already
+        processed by a previous import, unless they have changed
+    '''
+
+    position = 0
+    for filepath in sources:
+        source = os.path.abspath(filepath)
+        stat = os.stat(source)
+        stamp = (stat.st_size, int(stat.st_mtime))
+
+        if manifest is not None and manifest.source_done(source, stamp):
+            log.debug("Skipping '%s', already imported", filepath)
+            position += stamp[0]
+            continue
 
-                if ext == "sgf":
-                    yield filepath
+        with open(filepath, 'rb') as fp:
+            try:
+                if os.path.splitext(filepath)[1][1:].lower() == "sgf":
+                    members = [("", stamp, fp.read)]
+                else:
+                    log.info("Processing archive '%s'", filepath)
+                    members = read_archive(fp, filepath)
+
+                for member, memberstamp, read in members:
+                    if manifest is None or manifest.outcome(source, member, memberstamp) is None:
+                        yield source, member, memberstamp, read(), position + fp.tell()
+
+            except (ExtractError, tarfile.TarError, zipfile.BadZipfile) as e:
+                log.warn("Error reading %s: %s", filepath, e)
+                position += stamp[0]
+                continue
 
-                elif ext in ['zip', 'gz', 'bz2', 'xz']:
-                    try:
-                        log.info("Processing archive '%s'", filepath)
-                        destdir = os.path.join(archivecachedir, name)
-                        extract(filepath, destdir)
-                        dirs.append(destdir)
-                    except ExtractError as e:
-                        log.warn("Error extracting %s: %s", filepath, e)
+        position += stamp[0]
+        yield source, None, stamp, None, position
 
 
 def import_sources():
-    '''Import source SGF files/archives/folders to the Library'''
+    '''Import source SGF files/archives/folders to the Library
+        Games are parsed, filtered and played by _import_game(), possibly in
+        multiple worker processes. Duplicate detection, copying to the Library
+        and all bookkeeping happen in this (parent) process, in file order
+        The outcome for each source game is saved in the Library index, so
+        games imported or ignored by previous imports are not read again
+        Positions, local patterns and openings of imported games are added to
+        the position and pattern indexes and to the opening trie
+        Duplicates are found by game fingerprint, so rotated and mirrored
+        copies of a game are also rejected. Fingerprints of all Library games
+        are loaded once, and shared with workers
+    '''
 
     files = 0
     games = 0
-    skip = {
-        'size': 0,
-        'result': 0,
-        'rank': 0,
-        'handicap': 0,
-        'fewmoves': 0,
-        'rules': 0,
-        'date': 0,
-        'error': 0,
-        'duplicate': 0,
-    }
-
-    library = [_ for _ in walk()]
+    skip = dict.fromkeys(SKIPREASONS, 0)
+
+    library = index()
     librarysize = len(library)
     if g.options.games and librarysize >= g.options.games:
         log.info("Library already has %d games. No games imported", librarysize)
         return
 
-    filelist = list(find_games(g.options.sources))
-    listsize = len(filelist)
+    _fingerprints.clear()
+    _fingerprints.update(library.fingerprints())
+
+    sources = list(find_sources(g.options.sources))
+    sourcesize = sum(os.path.getsize(_) for _ in sources)
+
+    class SourceGameProgress(progressbar.ProgressBarWidget):
+        '''Custom Widget for ProgressBar to track games read from sources'''
+        def update(self, pbar):  # @UnusedVariable
+            return str(files)
 
     class ImportedGameProgress(progressbar.ProgressBarWidget):
         '''Custom Widget for ProgressBar to track imported games'''
@@ -120,91 +187,193 @@ def import_sources():
         '''Custom Widget for ProgressBar to track Library size'''
         def update(self, pbar):  # @UnusedVariable
             size = games + librarysize
+            if not g.options.games:
+                return str(size)
             return '%d of %d (%.01f%%)' % (size, g.options.games, 100. * size / g.options.games)
 
     pbar = progressbar.ProgressBar(widgets=[
         ' ', progressbar.Percentage(),
-        ' File ', progressbar.SimpleProgress(),
+        ' Game ', SourceGameProgress(),
         ', ', ImportedGameProgress(), ' imported.',
         ' Library: ', LibraryProgress(),
         ' ', progressbar.Bar('.'),
         ' ', progressbar.ETA(),
-        ' '], maxval=listsize).start()
+        ' '], maxval=sourcesize).start()
+
+    jobs = g.options.jobs or multiprocessing.cpu_count()
+    if jobs > 1:
+        log.info("Importing using %d processes", jobs)
+        pool = multiprocessing.Pool(jobs, utils.init_worker)
+        mapper = lambda batch: pool.imap(_import_game, batch, chunksize=16)
+    else:
+        pool = None
+        mapper = lambda batch: itertools.imap(_import_game, batch)
+
+    # Games are read from sources in batches, as feeding the pool from a
+    # generator would otherwise load all sources to memory at once
+    def results():
+        manifest = None if g.options.rescan else library
+        for batch in utils.batches(find_games(sources, manifest), 64 * jobs):
+            games = mapper([(_gamename(source, member), sgfdata)
+                            for source, member, _, sgfdata, _ in batch if member is not None])
+            for item in batch:
+                yield item + ((None, None, None) if item[1] is None else games.next(),)
 
     try:
-        for files, filename in enumerate(filelist, 1):
-            pbar.update(files)
-
-            try:
-                game = gogame.GoGame(filename, autosetup=False, autoplay=False)
-            except gogame.GoGameError as e:
-                log.error("Game %s: %s", filename, e)
-                skip['error'] += 1
-                continue
-
-            # Header filters (that do not depend on setup or plays)
-            if not filter_game_header(game, skip):
-                continue
+        for source, member, stamp, sgfdata, position, (reason, entry, keys) in results():
+            pbar.update(position)
 
-            # Populate Game ID and moves
-            try:
-                game.setup()
-            except gogame.GoGameError as e:
-                log.error("Game %s: %s", filename, e)
-                skip['error'] += 1
+            if member is None:
+                # All games in source processed
+                library.set_source_done(source, stamp)
                 continue
 
-            # Duplicate game
-            gamepath = os.path.join(g.LIBRARYDIR, game.id[:2], "%s.sgf" % game.id)
-            if os.path.exists(gamepath):
-                skip['duplicate'] += 1
-                continue
+            files += 1
+            filename = _gamename(source, member)
 
-            # Few moves
-            if len(game.sgfplays) < 50:
-                log.warn("Game %s: only %d moves", filename, len(game.sgfplays))
-                skip['fewmoves'] += 1
-                continue
+            # Duplicate game. Workers also check this before playing the game,
+            # but only here it also catches duplicates within the sources
+            if not reason and entry['fingerprint'] in _fingerprints:
+                reason = 'duplicate'
 
-            try:
-                game.play()
-            except gogame.GoGameError as e:
-                log.error("Game %s: %s", filename, e)
-                skip['error'] += 1
+            if reason:
+                skip[reason] += 1
+                library.set_outcome(source, member, stamp, reason, entry and entry['id'])
                 continue
 
-            log.debug("Importing '%s' from %s", game.id, filename)
-            utils.safemakedirs(os.path.dirname(gamepath))
-            shutil.copyfile(filename, gamepath)
+            # Different game with the same ID, played by a worker before it
+            # could see the other one. Both games used the same boards cache
+            # record, so both are played again
+            if entry['id'] in library:
+                gameid = entry['id']
+                entry['id'] = _uniqueid(gameid)
+                log.warn("Game %s: ID %s already in Library, renamed to %s", filename, gameid, entry['id'])
+                gogame.GoGame(filename, id=entry['id'], autoplay=False, sgfdata=sgfdata).play(refresh=True)
+                game(gameid).play(refresh=True)
+
+            log.debug("Importing '%s' from %s", entry['id'], filename)
+            librarypack().put(entry['id'], sgfdata)
+            library.add(entry)
+            add_keys(entry, keys)
+            library.set_outcome(source, member, stamp, 'imported', entry['id'])
+            _fingerprints.add(entry['fingerprint'])
 
             games += 1
+            if games % 100 == 0:
+                library.commit()  # So workers also see them
             if g.options.games and games + librarysize >= g.options.games:
                 break
 
     except KeyboardInterrupt:
         log.warn("Import aborted by user")
 
+    finally:
+        library.commit()
+        positionindex().flush()
+        patternindex().flush()
+        openingtrie().flush()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
     pbar.finish()
-    log.info("Files processed: %d", files)
+    log.info("Games processed: %d", files)
     log.info("Ignored games: %r", skip)
-    log.info("Games imported: %d (%.01f%%)", games, 100. * games / files)
+    log.info("Games imported: %d (%.01f%%)", games, 100. * games / (files or 1))
+    log.info("Outcomes of all games ever read from sources: %r",
+             library.outcomes([os.path.abspath(_) for _ in sources]))
     log.info("Games in Library: %d", games + librarysize)
 
 
-def filter_game_header(game, skip):
+def _gamename(source, member):
+    if member:
+        return os.path.join(source, member)
+    return source
+
+
+def _import_game(source):
+    '''Parse, filter and play a (filename, sgfdata) source game, without
+        changing the Library
+        Return a (reason, entry, keys) tuple. <reason> is the skip counter key
+        if the game was rejected, or None if it should be imported. <entry> is
+        the Library index entry of an accepted game, and <keys> its data for
+        the position and pattern indexes and opening trie, see game_keys()
+    '''
+    filename, sgfdata = source
+
+    # Header filters, on the root node alone, before parsing the whole game
+    try:
+        header = gogame.read_header(sgfdata)
+    except gogame.GoGameError as e:
+        log.error("Game %s: %s", filename, e)
+        return 'error', None, None
+
+    skip = dict.fromkeys(SKIPREASONS, 0)
+    if not filter_game_header(header, skip):
+        return [k for k, v in skip.iteritems() if v][0], None, None
+
+    try:
+        game = gogame.GoGame(filename, autosetup=False, autoplay=False, sgfdata=sgfdata)
+    except gogame.GoGameError as e:
+        log.error("Game %s: %s", filename, e)
+        return 'error', None, None
+
+    # Populate Game ID and moves
+    try:
+        game.setup()
+    except gogame.GoGameError as e:
+        log.error("Game %s: %s", filename, e)
+        return 'error', None, None
+
+    # Duplicate game, already in Library
+    if game.fingerprint in _fingerprints:
+        return 'duplicate', None, None
+
+    # Different game with the same ID
+    if game.id in index():
+        game.id = _uniqueid(game.id)
+
+    # Few moves
+    if len(game.moves) < 50:
+        log.warn("Game %s: only %d moves", filename, len(game.moves))
+        return 'fewmoves', None, None
+
+    # Always played, as cached boards may belong to a game with the same ID
+    try:
+        game.play(refresh=True)
+    except gogame.GoGameError as e:
+        log.error("Game %s: %s", filename, e)
+        return 'error', None, None
+
+    return None, index_entry(game, header, filename), game_keys(game)
+
+
+def _uniqueid(gameid):
+    '''Return <gameid> with the first numeric suffix not in Library'''
+    for suffix in itertools.count(2):
+        newid = "%s-%d" % (gameid, suffix)
+        if newid not in index():
+            return newid
+
+
+def filter_game_header(header, skip):
+    '''Apply the import filters to a <header> dict of game root properties,
+        as read by gogame.read_header(), counting rejections in <skip>
+        Return True if game passes all filters
+    '''
     # Rules
-    if not game.header.has_property("RU") or game.header.get("RU").lower() != "japanese":
+    if "RU" not in header or header["RU"].lower() != "japanese":
         skip['rules'] += 1
         return
 
     # Handicap
-    if game.header.has_property("HA"):
+    if "HA" in header:
         skip['handicap'] += 1
         return
 
     # Result
     try:
-        result = game.header.get("RE").split('+')[1].lower()
+        result = header["RE"].split('+')[1].lower()
         if result:
             if result[0] in ['r', 't', 'f']:
                 # Resign, Timeout, Forfeit
@@ -220,7 +389,7 @@ def filter_game_header(game, skip):
 
     # Player Rank
     try:
-        for rank in [game.header.get("BR"), game.header.get("WR")]:
+        for rank in [header["BR"], header["WR"]]:
             level, grade = int(rank[:-1]), rank[-1]
             if grade not in ['d', 'p'] or (grade == 'd' and level < 6):
                 skip['nopro'] += 1
@@ -230,39 +399,215 @@ def filter_game_header(game, skip):
         return
 
     # Date
-    if not game.header.has_property("DT"):
+    if "DT" not in header:
         skip['date'] += 1
         return
 
     # Board Size
-    if not game.size == g.options.board_size:
+    try:
+        size = int(header.get("SZ", 19))
+    except ValueError:
+        size = 0
+    if not size == g.options.board_size:
         skip['size'] += 1
         return
 
     return True
 
 
+def index():
+    '''Return the Library index, opened once per process
+        A missing index is rebuilt from the games in Library
+    '''
+    global _index
+    if _index is None or _index.pid != os.getpid():
+        _index = libindex.LibraryIndex(g.INDEXFILE)
+        if _index.created and (os.path.exists(g.LIBRARYFILE) or os.path.isdir(g.LIBRARYDIR)):
+            _rebuild_index(_index)
+    return _index
+
+
+def positionindex():
+    '''Return the position index of Library games'''
+    global _positions
+    if _positions is None:
+        _positions = libpositions.PositionIndex(g.POSITIONSFILE)
+    return _positions
+
+
+def patternindex():
+    '''Return the local pattern index of Library games'''
+    global _patterns
+    if _patterns is None:
+        _patterns = libpositions.PositionIndex(g.PATTERNSFILE)
+    return _patterns
+
+
+def openingtrie():
+    '''Return the opening trie of Library games'''
+    global _openings
+    if _openings is None:
+        _openings = libopenings.OpeningTrie(g.OPENINGSFILE)
+    return _openings
+
+
+def game_keys(game):
+    '''Return a dict of the keys of a played <game> in each Library index:
+        board hashes, (moves, hashes) of local patterns and opening move codes
+    '''
+    return dict(positions=game.hashes()[1:],
+                patterns=game.patterns(),
+                opening=libopenings.encode(game.moves, game.size))
+
+
+def add_keys(entry, keys):
+    '''Add a game, given its Library index <entry> and its <keys> from
+        game_keys(), to the position and pattern indexes and opening trie
+    '''
+    moves, patterns = keys['patterns']
+    positionindex().add(entry['id'], keys['positions'])
+    patternindex().add(entry['id'], patterns, moves)
+    openingtrie().add(entry['id'], keys['opening'], entry['winner'], entry['size'])
+
+
+def rebuild_positions():
+    '''Rebuild the position and pattern indexes from the games in Library'''
+    positions = positionindex()
+    patterns = patternindex()
+    positions.clear()
+    patterns.clear()
+    for game in games(autoplay=True):
+        moves, hashes = game.patterns()
+        positions.add(game.id, game.hashes()[1:])
+        patterns.add(game.id, hashes, moves)
+    positions.flush()
+    patterns.flush()
+    log.info("Positions indexed: %d, from %d games", len(positions), len(positions.gameids))
+    log.info("Patterns indexed: %d", len(patterns))
+
+
+def rebuild_openings(depth=libopenings.DEPTH):
+    '''Rebuild the opening trie from the moves of games in Library, with the
+        first <depth> moves of each game
+    '''
+    openings = openingtrie()
+    openings.clear(depth)
+    for entry in index().entries():
+        game = gogame.GoGame(entry['path'], id=entry['id'], sgfdata=librarypack().get(entry['id']), autoplay=False)
+        openings.add(game.id, libopenings.encode(game.moves, game.size), game.winner, game.size)
+    openings.flush()
+    log.info("Openings of %d games, first %d moves, in %d nodes", len(openings), depth, len(openings.code))
+
+
+def librarypack():
+    '''Return the Pack holding the SGF data of all Library games, by Game ID'''
+    return pack.get_pack(g.LIBRARYFILE)
+
+
+def index_entry(game, header, path):
+    '''Return the Library index entry of a set up <game> with <header> root
+        properties, imported from the SGF file at <path>
+    '''
+    return dict(id=game.id,
+                path=path,
+                header=header,
+                moves=len(game.moves),
+                winner=game.winner,
+                size=game.size,
+                fingerprint=game.fingerprint)
+
+
+def rebuild_index():
+    '''Rebuild the Library index from the games in Library'''
+    library = index()
+    if not library.created:  # Otherwise it was just built by index()
+        _rebuild_index(library)
+
+
+def _rebuild_index(library):
+    log.info("Indexing games in %s", g.LIBRARYFILE)
+    library.clear()
+    games = librarypack()
+    for gameid in games.keys():
+        _index_game(library, gameid, games.get(gameid), gameid)
+
+    # Loose SGF files, such as the pre-built Library, are packed as well
+    for filepath in walk():
+        gameid = os.path.splitext(os.path.basename(filepath))[0]
+        if gameid not in games:
+            with open(filepath, 'rb') as fp:
+                sgfdata = fp.read()
+            if _index_game(library, gameid, sgfdata, filepath):
+                games.put(gameid, sgfdata)
+
+    library.commit()
+    log.info("Games in Library: %d", len(library))
+
+
+def _index_game(library, gameid, sgfdata, path):
+    try:
+        game = gogame.GoGame(path, id=gameid, autoplay=False, sgfdata=sgfdata)
+        library.add(index_entry(game, gogame.read_header(sgfdata), path))
+        return True
+    except gogame.GoGameError as e:
+        log.error("Game %s: %s", path, e)
+
+
+def compact():
+    '''Reclaim space in Library, boards and moves packs, dropping superseded
+        records and records of games not in Library index
+    '''
+    gameids = set(index().gameids())
+    for path in [g.LIBRARYFILE, g.BOARDSFILE, g.MOVESFILE]:
+        log.info("Compacting %s", path)
+        reclaimed = pack.get_pack(path).compact(gameids)
+        log.info("%.01f MB reclaimed", reclaimed / 1024. ** 2)
+
+
 def walk():
+    '''Yield the path of all loose SGF files in Library directory
+        Library games are stored in the Library pack and listed by the index,
+        so this is only used when rebuilding the index
+    '''
     for root, _, files in os.walk(g.LIBRARYDIR):
         for name in files:
             filepath = os.path.join(root, name)
             if os.path.splitext(name)[1][1:].lower() == "sgf":
                 yield filepath
 
-def gameids(maxgames=0):
-    for i, filename in enumerate(walk(), 1):
-        yield os.path.splitext(os.path.basename(filename))[0]
-        if maxgames and i >= maxgames:
-            break
 
-def gamefile(gameid):
-    return os.path.join(g.LIBRARYDIR, id[:2], "%s.sgf" % gameid)
+class GameInfo(object):
+    '''A Library game as known by its index <entry>, without reading its SGF
+        Same header attributes as gogame.GoGame, plus its fingerprint and
+        number of moves. Moves and boards are not available
+    '''
+    def __init__(self, entry):
+        self.id = entry['id']
+        self.sgffile = entry['path']
+        self.header = entry['header']
+        self.size = entry['size']
+        self.winner = entry['winner']
+        self.description = gogame.describe(self.header)
+        self.fingerprint = entry['fingerprint']
+        self.nummoves = entry['moves']
+        self.initialboard = None
+
+
+def gameids(maxgames=0):
+    return index().gameids(maxgames)
 
 def game(gameid, autosetup=True, autoplay=False):
-    return gogame.GoGame(gamefile(gameid), autosetup=autosetup, autoplay=autoplay)
+    sgfdata = librarypack().get(gameid)
+    if sgfdata is None:
+        raise gogame.GoGameError("Game %s not found in Library" % gameid)
+    return gogame.GoGame(gameid, id=gameid, autosetup=autosetup, autoplay=autoplay, sgfdata=sgfdata)
+
+def gameinfo(gameid):
+    entry = index().get(gameid)
+    if entry is None:
+        raise gogame.GoGameError("Game %s not found in Library" % gameid)
+    return GameInfo(entry)
 
 def games(maxgames=0, autosetup=True, autoplay=False):
-    for i, filename in enumerate(walk(), 1):
-        yield gogame.GoGame(filename, autosetup=autosetup, autoplay=autoplay)
-        if maxgames and i >= maxgames:
-            break
+    for gameid in gameids(maxgames):
+        yield game(gameid, autosetup=autosetup, autoplay=autoplay)
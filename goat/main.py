@@ -24,12 +24,19 @@ import os
 import ConfigParser
 import shutil
 import time
+import itertools
+import collections
+import multiprocessing
 
 import progressbar
+import numpy
 
 import globals as g
 import calcs
+import features
+import gogame
 import library
+import openings
 import utils
 
 
@@ -55,6 +62,16 @@ def setup_log():
     logger.addHandler(sh)
 
 
+def atleast(minimum):
+    '''Return an argparse type of integers not lower than <minimum>'''
+    def integer(value):
+        number = int(value)
+        if number < minimum:
+            raise argparse.ArgumentTypeError("must be at least %d: %s" % (minimum, value))
+        return number
+    return integer
+
+
 def main(argv=None):
     '''App entry point
         <args> is a list of command line arguments, defaults to sys.argv[1:]
@@ -72,6 +89,9 @@ def main(argv=None):
     config.read(configfilename)
 
     board_size = config.getint('general', 'board_size')
+    board_cache = config.get('general', 'board_cache')
+
+    hooknames = sorted(calcs.hookclasses())
 
     parser = argparse.ArgumentParser(description="Go Analysis Tool")
 
@@ -84,6 +104,10 @@ def main(argv=None):
     parser.add_argument('--board-size', '-b', dest='board_size', default=board_size, type=int,
                            help="Board size. Default: %d" % board_size)
 
+    parser.add_argument('--board-cache', '-c', dest='board_cache', default=board_cache, choices=('boards', 'moves'),
+                        help="How played games are cached: 'boards' stores every board, 'moves' stores only"
+                             " moves and captures, and replays them when reading. Default: %s" % board_cache)
+
     parser.add_argument('--publish', '-p', dest='publish', default=False, action="store_true",
                         help="Publish run: generate charts and results in all formats.")
 
@@ -94,17 +118,102 @@ def main(argv=None):
     subparser.add_argument('--games', '-g', dest='games', default=0, type=int, metavar="NUM",
                            help="Import games until library has at least NUM games. 0 for no library size limit.")
 
+    subparser.add_argument('--jobs', '-j', dest='jobs', default=1, type=atleast(0), metavar="NUM",
+                           help="Use NUM processes to parse and play source games. 0 for one per CPU. Default: 1")
+
+    subparser.add_argument('--rescan', '-r', dest='rescan', default=False, action="store_true",
+                           help="Read again all source games, including the ones already processed by a previous import.")
+
     subparser.add_argument(dest='sources', nargs="+",metavar="SOURCEDIR",
                            help="Paths containing game sources to import to Library. "
                                 "Sources are SGF files or archives in ZIP and TAR.{BZ2,GZ} format")
 
+    subparser = subparsers.add_parser('index', help="Rebuild Library index from games in Library directory")
+
+    subparser = subparsers.add_parser('compact', help="Reclaim unused space in Library, boards and moves packs")
+
     subparser = subparsers.add_parser('compute', help="Perform game analysis")
 
     subparser.add_argument('--games', '-g', dest='games', default=0, type=int, metavar="NUM",
                            help="Compute at most NUM games. 0 for all games.")
 
+    subparser.add_argument('--batch', '-B', dest='batch', default=1000, type=atleast(1), metavar="NUM",
+                           help="Analyse final boards of NUM games at once, for hooks that support it,"
+                                " and hand out games to processes in chunks of NUM. Default: 1000")
+
+    subparser.add_argument('--jobs', '-j', dest='jobs', default=1, type=atleast(0), metavar="NUM",
+                           help="Use NUM processes to compute games. 0 for one per CPU. Default: 1")
+
+    subparser.add_argument('--full', '-F', dest='full', default=False, action="store_true",
+                           help="Compute all games again, including the ones already computed"
+                                " by a previous run of incremental hooks.")
+
+    subparser.add_argument('--hooks', '-H', dest='hooks', default=['densitygradient'], nargs="+",
+                           choices=hooknames, metavar="HOOK",
+                           help="Hooks to run, in a single pass, with the hooks they require."
+                                " Choices: %s. Default: densitygradient" % ", ".join(hooknames))
+
     subparser = subparsers.add_parser('display', help="Display analysis results")
 
+    subparser.add_argument('--hooks', '-H', dest='hooks', default=['severity'], nargs="+",
+                           choices=hooknames, metavar="HOOK",
+                           help="Hooks to display results of. Default: severity")
+
+    subparser = subparsers.add_parser('positions', help="Query the index of positions of Library games."
+                                      " Without --game, list the most frequent positions")
+
+    subparser.add_argument('--game', '-G', dest='game', default="", metavar="ID",
+                           help="List the games reaching the position of game ID after --move")
+
+    subparser.add_argument('--move', '-m', dest='move', default=0, type=int, metavar="NUM",
+                           help="Move number of the position of --game. Default: last move")
+
+    subparser.add_argument('--after', '-a', dest='after', default=0, type=int, metavar="NUM",
+                           help="Only count positions reached after move NUM or later")
+
+    subparser.add_argument('--top', '-t', dest='top', default=10, type=int, metavar="NUM",
+                           help="Number of most frequent positions to list. Default: 10")
+
+    subparser.add_argument('--rebuild', '-r', dest='rebuild', default=False, action="store_true",
+                           help="Rebuild the position and pattern indexes from games in Library")
+
+    subparser = subparsers.add_parser('openings', help="Show how often an opening line was played in Library"
+                                      " games, its win rates and most common continuations")
+
+    subparser.add_argument('--moves', '-M', dest='moves', default="", metavar="POINTS",
+                           help="Opening line, as SGF points separated by spaces, black playing first."
+                                " Default: no moves, for the statistics of first moves")
+
+    subparser.add_argument('--top', '-t', dest='top', default=10, type=int, metavar="NUM",
+                           help="Number of most common continuations to list. Default: 10")
+
+    subparser.add_argument('--rebuild', '-r', dest='rebuild', default=False, action="store_true",
+                           help="Rebuild the opening trie from games in Library")
+
+    subparser.add_argument('--depth', '-D', dest='depth', default=openings.DEPTH, type=int, metavar="NUM",
+                           help="Number of moves of each game in rebuilt trie. Default: %d" % openings.DEPTH)
+
+    subparser = subparsers.add_parser('search', help="Find the moves of Library games playing a local pattern,"
+                                      " the %dx%d area centered at the played stone, in any orientation"
+                                      % (gogame.PATTERN_SIZE, gogame.PATTERN_SIZE))
+
+    subparser.add_argument('--pattern', '-P', dest='pattern', default="", metavar="ROWS",
+                           help="Pattern to search, rows separated by '/'. Points are '.' for empty,"
+                                " '#' or 'x' for black, 'o' for white and '-' for off-board."
+                                " Use --pattern=ROWS if ROWS starts with '-'")
+
+    subparser.add_argument('--game', '-G', dest='game', default="", metavar="ID",
+                           help="Search the pattern played by game ID at --move")
+
+    subparser.add_argument('--move', '-m', dest='move', default=0, type=int, metavar="NUM",
+                           help="Move number of the pattern of --game")
+
+    subparser.add_argument('--after', '-a', dest='after', default=0, type=int, metavar="NUM",
+                           help="Only list moves NUM or later")
+
+    subparser.add_argument('--rebuild', '-r', dest='rebuild', default=False, action="store_true",
+                           help="Rebuild the position and pattern indexes from games in Library")
+
     if argv is None:
         argv = sys.argv[1:]
     g.options = parser.parse_args(argv)
@@ -118,62 +227,124 @@ def main(argv=None):
     if g.options.command == "import":
         library.import_sources()
 
+    elif g.options.command == "index":
+        library.rebuild_index()
+
+    elif g.options.command == "compact":
+        library.compact()
+
     elif g.options.command == "compute":
         compute()
 
     elif g.options.command == "display":
         display()
 
+    elif g.options.command == "positions":
+        positions()
+
+    elif g.options.command == "search":
+        search()
+
+    elif g.options.command == "openings":
+        openingstats()
+
     log.info("Finished in %s", time.strftime('%H:%M:%S', time.gmtime(time.time()-start)))
 
 
+def compute_hooks():
+    '''Return new instances of the hooks run by compute, in dependency order'''
+    return calcs.schedule(g.options.hooks, g.options.board_size)
+
+
 def compute():
+    '''Run all hooks on Library games
+        Games are processed in chunks of --batch games. With --jobs, chunks are
+        run by worker processes, each with new hooks that start with no data
+        and are merged, in game order, into the hooks of this process. Every
+        5000 games, hooks chart that game and save their data and results
+
+        Incremental hooks skip games they already computed, unless their moves
+        changed, and forget games no longer in Library. Games skipped by all
+        hooks are not even loaded, so after an import only new games are
+        computed. Hooks compute a game again when a hook they require does,
+        and required hooks compute games their dependents need but whose data
+        they lack, or every such game when worker processes, which start with
+        no data, are used
+    '''
+    try:
+        hooks = compute_hooks()
+    except ValueError as e:
+        log.error(e)
+        return
+    log.info("Hooks: %s", ", ".join(_.__class__.__name__ for _ in hooks))
 
-    hooks = [
-#        calcs.StonesPerSquare(g.options.board_size),
-#        calcs.LibertiesPerMove(g.options.board_size),
-#        calcs.Territories(g.options.board_size),
-#        calcs.FractalDimension(g.options.board_size),
-#        calcs.TimeLine(g.options.board_size),
-#        calcs.MoveHistogram(g.options.board_size),
-#        calcs.Severity(g.options.board_size),
-        calcs.DensityGradient(g.options.board_size),
-    ]
+    jobs = g.options.jobs or multiprocessing.cpu_count()
+    names = [_.__class__.__name__ for _ in hooks]
+    required = [[names.index(_) for _ in hook.requires] for hook in hooks]
 
-    gameids = list(library.gameids(g.options.games))
-    totalgames = len(gameids)
+    libraryids = set(library.gameids())
+    for hook in hooks:
+        hook.prune(libraryids)
+
+    entries = list(library.index().fingerprinted(g.options.games))
+    pending = []  # (game number, Game ID, fingerprint, indexes of hooks to run)
+    for number, (gameid, fingerprint) in enumerate(entries, 1):
+        needed = set(i for i, hook in enumerate(hooks)
+                     if g.options.full or hook.needs(gameid, fingerprint))
+        for i in xrange(len(hooks)):
+            if needed.intersection(required[i]):
+                needed.add(i)
+        for i in reversed(xrange(len(hooks))):
+            if i in needed:
+                needed.update(_ for _ in required[i] if jobs > 1 or gameid not in hooks[_].data)
+        if needed:
+            pending.append((number, gameid, fingerprint, tuple(sorted(needed))))
+    log.info("Games to compute: %d, already computed: %d", len(pending), len(entries) - len(pending))
+    if not pending:
+        for hook in hooks:
+            hook.end()  # Save pruned data and chart results
+        return
+    chunks = utils.batches(pending, g.options.batch)
 
     pbar = progressbar.ProgressBar(widgets=[
         ' ', progressbar.Percentage(),
         ' Game ', progressbar.SimpleProgress(),
         ' ', progressbar.Bar('.'),
         ' ', progressbar.ETA(),
-        ' '], maxval=totalgames).start()
-
+        ' '], maxval=len(pending)).start()
+
+    if jobs > 1:
+        log.info("Computing using %d processes", jobs)
+        pool = multiprocessing.Pool(jobs, _init_compute_worker)
+        results = pool.imap(_compute_worker, chunks)
+    else:
+        pool = None
+        results = (compute_games(hooks, chunk, lambda: pbar.update(pbar.currval + 1))
+                   for chunk in chunks)
+
+    games = last = 0
     try:
-        for games, id in enumerate(gameids, 1):
-            game = library.game(id)
-            chart = games % 5000 == 0
-
-            for hook in hooks:
-                hook.gamestart(game, game.initialboard, chart=chart)
-
-            board = None
-            for board, move in zip(game.boards, game.moves):
-                for hook in hooks:
-                    hook.move(game, board, move)
-
-            for hook in hooks:
-                hook.gameover(game, board, chart=chart)
+        for result in results:
+            if pool is not None:
+                for hook, other in zip(hooks, result.hooks):
+                    hook.merge(other)
 
-            if games % 5000 == 0:
+            if last // 5000 < result.last // 5000:
                 for hook in hooks:
                     hook.end()
-
+            last = result.last
+            games += result.games
             pbar.update(games)
 
     except KeyboardInterrupt:
         log.warn("Aborted by user")
+        if pool is None:
+            games = pbar.currval  # Games of the interrupted chunk were also processed
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
 
     pbar.finish()
     for hook in hooks:
@@ -182,16 +353,196 @@ def compute():
     log.info("Games processed: %d", games)
 
 
+ComputeResult = collections.namedtuple('ComputeResult', 'last games hooks')
+
+
+def compute_games(hooks, games, progress=None):
+    '''Run <hooks> on <games>, a list of (game number, Game ID, fingerprint,
+        indexes of the hooks to run) tuples, calling <progress>() after each
+        game, if given. Each game is loaded only up to the data level needed
+        by its hooks: a library.GameInfo from the Library index alone if they
+        only need headers, otherwise a gogame.GoGame, played if they need
+        boards. Boards beyond the level of the hooks are None, and move(),
+        game() and batch() are only called for hooks that override them
+        Return a ComputeResult with the number of the last game processed and
+        the number of games processed
+    '''
+    movehooks  = set(i for i, hook in enumerate(hooks) if hook.overrides('move'))
+    gamehooks  = set(i for i, hook in enumerate(hooks) if hook.overrides('game'))
+    batchhooks = set(i for i, hook in enumerate(hooks) if hook.overrides('batch'))
+    batch = []  # (game, final board array, hook indexes, chart) of games not yet sent to batch hooks
+
+    def runbatch():
+        shared = {}  # Features of the final boards of each selection of games
+        for i in sorted(batchhooks):
+            selected = tuple(n for n, (_, _, needed, _) in enumerate(batch) if i in needed)
+            if selected:
+                if selected not in shared:
+                    shared[selected] = features.Features(numpy.array([batch[_][1] for _ in selected]))
+                charted = [n for n, m in enumerate(selected) if batch[m][3]]
+                hooks[i].batch([batch[_][0] for _ in selected], shared[selected].boards,
+                               shared[selected], chart=charted[0] if charted else None)
+        del batch[:]
+
+    number = count = 0
+    try:
+        for number, id, fingerprint, needed in games:
+            chart = number % 5000 == 0
+            active = [hooks[_] for _ in needed]
+            level = max(_.level for _ in active)
+            if level == calcs.HEADERS:
+                game = library.gameinfo(id)
+            else:
+                game = library.game(id)
+                if level >= calcs.FINAL:
+                    game.play()
+
+            for hook in active:
+                hook.gamestart(game, game.initialboard, chart=chart)
+
+            board = None
+            onmove = [hooks[_] for _ in needed if _ in movehooks]
+            if onmove:
+                for board, move in itertools.izip(game.boards, game.moves):
+                    for hook in onmove:
+                        hook.move(game, board, move)
+            elif level >= calcs.FINAL and game.boards:
+                board = game.boards[-1]
+
+            ongame = [hooks[_] for _ in needed if _ in gamehooks]
+            if ongame and game.boards:
+                boards = game.boards.array()
+                gamefeatures = features.Features(boards, game.initialboard.board,
+                                                 numpy.array([gogame.COLORS.index(color)
+                                                              for color, _ in game.moves]))
+                for hook in ongame:
+                    hook.game(game, boards, gamefeatures)
+
+            for hook in active:
+                hook.gameover(game, board, chart=chart)
+                hook.done(id, fingerprint)
+
+            if board is not None and batchhooks.intersection(needed):
+                batch.append((game, board.board, needed, chart))
+            if len(batch) >= g.options.batch:
+                runbatch()
+
+            count += 1
+            if progress is not None:
+                progress()
+
+    finally:
+        runbatch()
+
+    return ComputeResult(number, count, hooks)
+
+
+def _init_compute_worker():
+    utils.init_worker()
+    calcs.Hook.persistent = False
+
+
+def _compute_worker(games):
+    return compute_games(compute_hooks(), games)
+
+
+def positions():
+    if g.options.rebuild:
+        library.rebuild_positions()
+
+    index = library.positionindex()
+    if not len(index):
+        log.warn("Position index is empty. Use --rebuild to index games already in Library")
+        return
+
+    if g.options.game:
+        game = library.game(g.options.game, autoplay=True)
+        move = g.options.move or len(game.moves)
+        if not 0 < move <= len(game.moves):
+            log.error("Game %s has no move %d", game.id, move)
+            return
+        key = game.hashes()[move]
+        found = index.find(key, g.options.after)
+        log.info("Position of game %s after move %d:\n%s", game.id, move, game.boards[move - 1].ascii())
+        log.info("Reached %d times in %d games", *index.count(key, g.options.after))
+        for gameid, gamemove in found:
+            log.info("%s move %d", gameid, gamemove)
+        return
+
+    for key, count, gameid, move in index.frequencies(g.options.after, g.options.top):
+        log.info("Position %016x reached %d times, first in game %s after move %d:\n%s",
+                 key, count, gameid, move, library.game(gameid, autoplay=True).boards[move - 1].ascii())
+
+
+def openingstats():
+    if g.options.rebuild:
+        library.rebuild_openings(g.options.depth)
+
+    trie = library.openingtrie()
+    if not len(trie):
+        log.warn("Opening trie is empty. Use --rebuild to add games already in Library")
+        return
+
+    try:
+        moves = [(gogame.COLORS[1 + i % 2], gogame.parse_point(point, trie.size))
+                 for i, point in enumerate(g.options.moves.split())]
+    except gogame.GoGameError as e:
+        log.error(e)
+        return
+    if len(moves) >= trie.depth:
+        log.error("Trie only holds the first %d moves of each game", trie.depth)
+        return
+
+    def rates(games, black, white):
+        return "%d games, black wins %.01f%%, white wins %.01f%%" % (
+            games, 100. * black / (games or 1), 100. * white / (games or 1))
+
+    node = trie.find(moves)
+    if node < 0:
+        log.info("Opening line was never played")
+        return
+    log.info("Opening line: %s", rates(*trie.stats(node)))
+    for (color, coord), games, black, white in trie.continuations(node, g.options.top):
+        log.info("%s[%s]: %s", color, gogame.format_point(coord, trie.size), rates(games, black, white))
+
+
+def search():
+    if g.options.rebuild:
+        library.rebuild_positions()
+
+    index = library.patternindex()
+    if not len(index):
+        log.warn("Pattern index is empty. Use --rebuild to index games already in Library")
+        return
+
+    try:
+        if g.options.game:
+            game = library.game(g.options.game, autoplay=True)
+            moves, hashes = game.patterns()
+            played = numpy.flatnonzero(moves == g.options.move)
+            if not len(played):
+                log.error("Game %s has no stone played at move %d", game.id, g.options.move)
+                return
+            key = hashes[played[0]]
+        elif g.options.pattern:
+            pattern = gogame.parse_pattern(g.options.pattern)
+            center = (gogame.PATTERN_SIZE // 2) * (gogame.PATTERN_SIZE + 1)
+            key = gogame.hash_patterns(pattern[numpy.newaxis], [center])[0]
+        else:
+            log.error("Either --pattern or --game is required")
+            return
+    except gogame.GoGameError as e:
+        log.error(e)
+        return
+
+    found = index.find(key, g.options.after)
+    for gameid, move in found:
+        log.info("%s move %d", gameid, move)
+    log.info("Pattern played %d times in %d games", *index.count(key, g.options.after))
+
+
 def display():
-    hooks = [
-#        calcs.StonesPerSquare(g.options.board_size),
-#        calcs.LibertiesPerMove(g.options.board_size),
-#        calcs.Territories(g.options.board_size),
-#        calcs.FractalDimension(g.options.board_size),
-#        calcs.TimeLine(g.options.board_size),
-#        calcs.MoveHistogram(g.options.board_size),
-        calcs.Severity(g.options.board_size),
-#        calcs.DensityGradient(g.options.board_size),
-    ]
+    classes = calcs.hookclasses()
+    hooks = [classes[_](g.options.board_size) for _ in g.options.hooks]
     for hook in hooks:
         hook.display()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2014 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+'''Opening trie: prefix tree of the first moves of Library games'''
+
+import os
+import logging
+import bisect
+
+import numpy
+
+import gogame
+import utils
+
+
+log = logging.getLogger(__name__)
+
+DEPTH = 30  # Default number of moves of each game in the trie
+
+
+def encode(moves, size):
+    '''Return an array of the codes of <moves>, (color, (row, col)) tuples
+        of a <size> board. Codes are non-zero, and unique for each color and
+        point, passes included. See decode()
+    '''
+    npoints = size * size
+    return numpy.array([gogame.COLORS.index(color) * (npoints + 1) +
+                        (npoints if coord is None else coord[0] * size + coord[1])
+                        for color, coord in moves], dtype=numpy.uint16)
+
+
+def decode(code, size):
+    '''Return the (color, (row, col)) move of <code>, see encode()'''
+    npoints = size * size
+    color, point = divmod(int(code), npoints + 1)
+    return gogame.COLORS[color], (None if point == npoints else divmod(point, size))
+
+
+class OpeningTrie(object):
+    '''Prefix tree of the first <depth> moves of all Library games, stored at
+        <path>, with the number of games reaching each node and won by each
+        color
+
+        Nodes are kept in parallel arrays, in breadth-first order: the code of
+        the move leading to each node, its parent node and its game counters.
+        The root is node 0, the position before the first move. Children of a
+        node are contiguous and sorted by move code, so finding a child is a
+        binary search in the codes of its siblings
+
+        The move codes of each game are also kept, so games added by add() are
+        merged by rebuilding the trie with numpy when flush() is called
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._load()
+
+    def __len__(self):
+        '''Number of games in trie, including pending ones'''
+        return len(self.gameids) + len(self._pending)
+
+    def __contains__(self, gameid):
+        return gameid in self._gameset
+
+    def add(self, gameid, codes, winner, size):
+        '''Add game <gameid> given its move <codes>, as returned by encode(),
+            its <winner> color, if any, and its board <size>. Only the first
+            <depth> moves are kept. Games already in trie are ignored
+        '''
+        if gameid in self._gameset:
+            return
+        if self.size and size != self.size:
+            log.warn("Game %s: board size %d, trie holds games of size %d", gameid, size, self.size)
+            return
+        self.size = size
+        self._pending.append((gameid, codes[:self.depth], gogame.COLORS.index(winner) if winner else 0))
+        self._gameset.add(gameid)
+
+    def find(self, moves):
+        '''Return the node reached by <moves>, a list of (color, (row, col))
+            tuples, or -1 if no game played them
+        '''
+        self.flush()
+        node = 0
+        for code in encode(moves, self.size).tolist():
+            start, end = self._children[node], self._children[node + 1]
+            node = bisect.bisect_left(self._codes, code, start, end)
+            if node == end or self._codes[node] != code:
+                return -1
+        return node
+
+    def stats(self, node):
+        '''Return the (games, black wins, white wins) counters of <node>'''
+        return int(self.games[node]), int(self.black[node]), int(self.white[node])
+
+    def continuations(self, node, top=10):
+        '''Return a list of (move, games, black wins, white wins) of the <top>
+            most played moves after <node>, most played first
+        '''
+        start, end = self._children[node], self._children[node + 1]
+        children = start + numpy.argsort(-self.games[start:end].astype(int), kind='mergesort')[:top]
+        return [(decode(self.code[_], self.size),) + self.stats(_) for _ in children]
+
+    def flush(self):
+        '''Rebuild the trie with games added since last flush, and save it'''
+        if not self._pending:
+            return
+
+        gameids, codes, winners = zip(*self._pending)
+        sequences = numpy.zeros((len(codes), self.depth), dtype=numpy.uint16)
+        for i, gamecodes in enumerate(codes):
+            sequences[i, :len(gamecodes)] = gamecodes
+        self.gameids = numpy.concatenate((self.gameids, gameids))
+        self.sequences = numpy.vstack((self.sequences, sequences))
+        self.winners = numpy.concatenate((self.winners, numpy.array(winners, dtype=numpy.uint8)))
+        self._pending = []
+        self._build()
+
+        log.debug("Saving opening trie of %d games, %d nodes, in %s", len(self.gameids), len(self.code), self.path)
+        utils.safemakedirs(os.path.dirname(self.path))
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as fp:
+            numpy.savez(fp, size=self.size, depth=self.depth, gameids=self.gameids,
+                        sequences=self.sequences, winners=self.winners,
+                        parent=self.parent, code=self.code,
+                        games=self.games, black=self.black, white=self.white)
+        os.rename(tmppath, self.path)
+
+    def clear(self, depth=DEPTH):
+        '''Remove all games, and set the trie <depth>'''
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._load(depth)
+
+    def _build(self):
+        '''Build the node arrays from the move codes of all games, one tree
+            level at a time: the nodes of each level are the unique (parent,
+            code) pairs of games still playing at that move
+        '''
+        stride = numpy.iinfo(numpy.uint16).max + 1
+        black = self.winners == 1
+        white = self.winners == 2
+
+        parent, code = [numpy.array([-1])], [numpy.array([0])]
+        games, blackwins, whitewins = [[len(self.winners)]], [[black.sum()]], [[white.sum()]]
+        nodes = numpy.zeros(len(self.winners), dtype=numpy.int64)  # Node of each game at current level
+        active = numpy.ones(len(self.winners), dtype=bool)
+        offset = 1
+        for level in xrange(self.depth):
+            active &= self.sequences[:, level] > 0
+            if not active.any():
+                break
+            keys, inverse = numpy.unique(nodes[active] * stride + self.sequences[active, level],
+                                         return_inverse=True)
+            parent.append(keys // stride)
+            code.append(keys % stride)
+            games.append(numpy.bincount(inverse))
+            blackwins.append(numpy.bincount(inverse, weights=black[active]))
+            whitewins.append(numpy.bincount(inverse, weights=white[active]))
+            nodes[active] = offset + inverse
+            offset += len(keys)
+
+        self.parent = numpy.concatenate(parent).astype(numpy.int32)
+        self.code   = numpy.concatenate(code).astype(numpy.uint16)
+        self.games  = numpy.concatenate(games).astype(numpy.uint32)
+        self.black  = numpy.concatenate(blackwins).astype(numpy.uint32)
+        self.white  = numpy.concatenate(whitewins).astype(numpy.uint32)
+        self._index()
+
+    def _index(self):
+        # Plain lists for fast lookups from Python: move codes, and the
+        # start of the children of each node, the end being the next start
+        self._codes = self.code.tolist()
+        self._children = numpy.searchsorted(self.parent, numpy.arange(len(self.parent) + 1)).tolist()
+
+    def _load(self, depth=DEPTH):
+        '''(Re-)read the trie file, discarding pending games'''
+        self._pending = []  # (gameid, codes, winner) added but not yet flushed
+
+        if os.path.exists(self.path):
+            data = numpy.load(self.path)
+            self.size  = int(data['size'])
+            self.depth = int(data['depth'])
+            for name in ('gameids', 'sequences', 'winners', 'parent', 'code', 'games', 'black', 'white'):
+                setattr(self, name, data[name])
+            self._index()
+        else:
+            self.size = 0
+            self.depth = depth
+            self.gameids   = numpy.zeros(0, dtype=str)
+            self.sequences = numpy.zeros((0, depth), dtype=numpy.uint16)
+            self.winners   = numpy.zeros(0, dtype=numpy.uint8)
+            self._build()
+
+        self._gameset = set(self.gameids.tolist())
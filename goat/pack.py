@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2014 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+'''Packed containers, single-file stores of many small records'''
+
+import os
+import logging
+import struct
+import mmap
+import fcntl
+import sqlite3
+import contextlib
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+_packs = {}
+
+
+def get_pack(path):
+    '''Return the Pack at <path>, opened once per process'''
+    pack = _packs.get(path)
+    if pack is None or pack.pid != os.getpid():
+        pack = _packs[path] = Pack(path)
+    return pack
+
+
+class Pack(object):
+    '''Append-only container of records identified by a string key
+        Records are appended to the data file at <path>, each prefixed by a
+        small header with its key and length, and read back using mmap.
+        Offsets are kept in an SQLite index at <path>.idx, so reading a record
+        takes a single seek. Adding an existing key supersedes the previous
+        record, which keeps taking space until compact()
+        Opening and appends are locked, so multiple processes can open and
+        write to the same Pack.
+        As the data file is self-describing, the index can always be rebuilt
+        from it
+    '''
+
+    _header = struct.Struct('<HI')  # key length, data length
+
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()  # Neither SQLite connections nor mmaps are shared with forked processes
+
+        utils.safemakedirs(os.path.dirname(self.path))
+        self.fp = open(self.path, 'ab+')
+        self.map = None
+
+        self.db = sqlite3.connect(self.path + '.idx')
+        self.db.text_factory = str
+
+        # Processes opening a new pack at the same time would race to create
+        # and index it, failing with schema changes made by each other
+        with self._locked():
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS records (
+                    key    TEXT PRIMARY KEY,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meta (
+                    name  TEXT PRIMARY KEY,
+                    value INTEGER
+                );
+            ''')
+
+            # Index belongs to another data file, for example if the pack was
+            # replaced by compact() in another process, or copied from elsewhere
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'inode'").fetchone()
+            if row is None or row[0] != os.fstat(self.fp.fileno()).st_ino:
+                self.reindex()
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def __contains__(self, key):
+        return self.db.execute("SELECT 1 FROM records WHERE key = ?", (key,)).fetchone() is not None
+
+    def keys(self):
+        '''Yield all keys, in the order their records are stored'''
+        for row in self.db.execute("SELECT key FROM records ORDER BY offset"):
+            yield row[0]
+
+    def get(self, key):
+        '''Return the data of record <key> as a string, or None if not found'''
+        view = self.view(key)
+        if view is not None:
+            return view[:]
+
+    def view(self, key):
+        '''Return the data of record <key> as a read-only buffer pointing to the
+            data file, without copying it, or None if not found
+        '''
+        row = self.db.execute("SELECT offset, length FROM records WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        offset, length = row
+        if self.map is None or offset + length > len(self.map):
+            self._remap()
+        return buffer(self.map, offset, length)
+
+    def put(self, key, data):
+        '''Append a record <key> with <data>, superseding any existing one'''
+        with self._locked():
+            self.fp.seek(0, os.SEEK_END)
+            offset = self.fp.tell() + self._header.size + len(key)
+            self.fp.write(self._header.pack(len(key), len(data)) + key)
+            self.fp.write(data)
+            self.fp.flush()
+            self.db.execute("INSERT OR REPLACE INTO records VALUES (?, ?, ?)", (key, offset, len(data)))
+            self.db.commit()
+
+    def compact(self, keys=None):
+        '''Rewrite the data file without superseded records, and also without
+            records whose key is not in <keys>, if given
+            Return the number of bytes reclaimed
+        '''
+        with self._locked():
+            if keys is not None:
+                keys = set(keys)
+            before = os.fstat(self.fp.fileno()).st_size
+            tmppath = self.path + '.tmp'
+            if before:
+                self._remap()
+            with open(tmppath, 'wb') as fp:
+                for key, offset, length in self.db.execute("SELECT key, offset, length"
+                                                           " FROM records ORDER BY offset"):
+                    if keys is None or key in keys:
+                        fp.write(self._header.pack(len(key), length) + key)
+                        fp.write(buffer(self.map, offset, length))
+            os.rename(tmppath, self.path)
+
+            self._close_data()
+            self.fp = open(self.path, 'ab+')
+            self.reindex()
+            return before - os.fstat(self.fp.fileno()).st_size
+
+    def reindex(self):
+        '''Rebuild the index by scanning the data file'''
+        log.debug("Indexing %s", self.path)
+        size = os.fstat(self.fp.fileno()).st_size
+        self.fp.seek(0)
+        records = {}
+        offset = 0
+        while True:
+            header = self.fp.read(self._header.size)
+            if len(header) < self._header.size:
+                break
+            keylength, length = self._header.unpack(header)
+            key = self.fp.read(keylength)
+            offset += self._header.size + keylength
+            if offset + length > size:
+                log.warn("Truncated record '%s' in %s", key, self.path)
+                break
+            records[key] = (key, offset, length)
+            offset += length
+            self.fp.seek(offset)
+
+        self.db.execute("DELETE FROM records")
+        self.db.executemany("INSERT INTO records VALUES (?, ?, ?)", records.itervalues())
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('inode', ?)",
+                        (os.fstat(self.fp.fileno()).st_ino,))
+        self.db.commit()
+
+    def close(self):
+        self._close_data()
+        self.db.close()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+
+    def _remap(self):
+        # Previous map is not closed, as buffers and arrays may still use it.
+        # It is unmapped when the last of them is gone
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_data(self):
+        self.map = None
+        self.fp.close()
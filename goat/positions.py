@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+#
+#    Copyright (C) 2014 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program. See <http://www.gnu.org/licenses/gpl.html>
+
+'''Persistent position indexes, mapping board or pattern hashes to the games
+    and moves reaching them
+'''
+
+import os
+import logging
+import struct
+
+import numpy
+
+import utils
+
+
+log = logging.getLogger(__name__)
+
+
+class PositionIndex(object):
+    '''Index of all positions of Library games, stored at <path>
+        Each position is the board after a move, identified by its 64-bit
+        Zobrist hash, as returned by gogame.GoGame.hashes(). The same index
+        also maps local pattern hashes to the moves playing them. Entries are
+        (key, game, move) records, sorted by key and stored as 3 columns:
+        uint64 keys, uint32 game numbers and uint16 move numbers, 14 bytes per
+        position. Game numbers index the list of Game IDs stored after them
+
+        The file is memory-mapped, so lookups are a binary search in the keys
+        column, touching only a few pages of it. Games added by add() are kept
+        in memory until flush() merges them into the file
+    '''
+
+    _magic = 'GOP1'
+    _header = struct.Struct('<4sIQ')  # magic, number of games, number of positions
+
+    def __init__(self, path):
+        self.path = path
+        self._load()
+
+    def __len__(self):
+        '''Number of indexed positions, including pending ones'''
+        return len(self.keys) + sum(len(keys) for _, keys, _ in self._pending)
+
+    def __contains__(self, gameid):
+        return gameid in self._gameset
+
+    def add(self, gameid, keys, moves=None):
+        '''Add the positions of <gameid>, given the <keys> of each of them and
+            their <moves> numbers. If <moves> is None, <keys> are the hashes of
+            the board after each move, from move 1. The initial board is never
+            indexed, as almost every game starts from the same one
+            Games already in index are ignored
+        '''
+        if gameid in self._gameset:
+            return
+        if moves is None:
+            moves = numpy.arange(1, len(keys) + 1)
+        if len(moves) and moves[-1] > numpy.iinfo(numpy.uint16).max:
+            log.warn("Game %s: too many moves to index positions", gameid)
+            return
+        self._pending.append((gameid,
+                              numpy.asarray(keys, dtype=numpy.uint64),
+                              numpy.asarray(moves, dtype=numpy.uint16)))
+        self._gameset.add(gameid)
+
+    def find(self, key, minmove=0):
+        '''Return a list of (gameid, move) of all positions with hash <key>,
+            reached after move <minmove> or later, sorted by game
+        '''
+        self.flush()
+        start, end = self._range(key)
+        games = self.games[start:end]
+        moves = self.moves[start:end]
+        found = moves >= minmove
+        return sorted(zip([self.gameids[_] for _ in games[found].tolist()], moves[found].tolist()))
+
+    def count(self, key, minmove=0):
+        '''Return the number of times position <key> was reached after move
+            <minmove> or later, and the number of games reaching it
+        '''
+        self.flush()
+        start, end = self._range(key)
+        games = self.games[start:end][self.moves[start:end] >= minmove]
+        return len(games), len(numpy.unique(games))
+
+    def frequencies(self, minmove=0, top=10):
+        '''Return a list of (key, positions, gameid, move) of the <top> most
+            frequent positions reached after move <minmove> or later, with the
+            first game and move reaching each of them
+        '''
+        self.flush()
+        selected = numpy.flatnonzero(self.moves >= minmove)
+        if not len(selected):
+            return []
+        keys = self.keys[selected]
+        starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(keys)))
+        result = []
+        for group in numpy.argsort(-counts, kind='mergesort')[:top]:
+            entry = selected[starts[group]]
+            result.append((int(keys[starts[group]]), int(counts[group]),
+                           self.gameids[self.games[entry]], int(self.moves[entry])))
+        return result
+
+    def flush(self):
+        '''Merge games added since last flush into the file'''
+        if not self._pending:
+            return
+
+        gameids = list(self.gameids)
+        keys, games, moves = [self.keys], [self.games], [self.moves]
+        for gameid, gamekeys, gamemoves in self._pending:
+            keys.append(gamekeys)
+            games.append(numpy.repeat(numpy.uint32(len(gameids)), len(gamekeys)))
+            moves.append(gamemoves)
+            gameids.append(gameid)
+        keys, games, moves = [numpy.concatenate(_) for _ in (keys, games, moves)]
+
+        # Stable sort keeps positions of each key in game and move order
+        order = numpy.argsort(keys, kind='mergesort')
+        log.debug("Indexing %d positions of %d games in %s",
+                  len(keys) - len(self.keys), len(self._pending), self.path)
+
+        utils.safemakedirs(os.path.dirname(self.path))
+        tmppath = self.path + '.tmp'
+        with open(tmppath, 'wb') as fp:
+            fp.write(self._header.pack(self._magic, len(gameids), len(keys)))
+            fp.write(keys[order].tostring())
+            fp.write(games[order].tostring())
+            fp.write(moves[order].tostring())
+            fp.write('\n'.join(gameids))
+        os.rename(tmppath, self.path)
+
+        self._load()
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._load()
+
+    def _range(self, key):
+        key = numpy.uint64(key)
+        return (numpy.searchsorted(self.keys, key, 'left'),
+                numpy.searchsorted(self.keys, key, 'right'))
+
+    def _load(self):
+        '''(Re-)read the index file, discarding pending games'''
+        self.gameids = []
+        self.keys  = numpy.zeros(0, dtype=numpy.uint64)
+        self.games = numpy.zeros(0, dtype=numpy.uint32)
+        self.moves = numpy.zeros(0, dtype=numpy.uint16)
+        self._gameset = set()
+        self._pending = []  # (gameid, hashes) added but not yet flushed
+
+        if not os.path.exists(self.path) or not os.path.getsize(self.path):
+            return
+
+        with open(self.path, 'rb') as fp:
+            magic, games, count = self._header.unpack(fp.read(self._header.size))
+        if magic != self._magic:
+            log.warn("Invalid position index %s, ignoring it", self.path)
+            return
+
+        offset = self._header.size
+        for name, dtype in (('keys', '<u8'), ('games', '<u4'), ('moves', '<u2')):
+            if count:
+                setattr(self, name, numpy.memmap(self.path, dtype=dtype, mode='r',
+                                                 offset=offset, shape=(count,)))
+            offset += count * numpy.dtype(dtype).itemsize
+
+        with open(self.path, 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read()
+        self.gameids = data.split('\n') if games else []
+        self._gameset = set(self.gameids)
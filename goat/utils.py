@@ -21,6 +21,8 @@ import os
 import sys
 import subprocess
 import json
+import itertools
+import signal
 
 
 def safemakedirs(path):
@@ -31,6 +33,23 @@ def safemakedirs(path):
             raise
 
 
+def init_worker():
+    '''Initializer of pool worker processes: ignore Ctrl+C, so the parent
+        process alone handles it and terminates the pool
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def batches(iterable, size):
+    '''Split <iterable> in lists of up to <size> items'''
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
 def launchfile(filename):
     if sys.platform.startswith('darwin'):
         subprocess.call(('open', filename))